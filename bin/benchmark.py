@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import sys
+import copy
+import timeit
+import shutil
+import argparse
+import tempfile
+
+import yaml
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(base_dir)
+from theconf import Config as C
+from theconf import ConfigArgumentParser
+from theconf.config import load_yaml, load_yamls
+
+
+def build_tree(width, depth):
+    if depth == 0:
+        return {'leaf%d' % i: i for i in range(width)}
+    return {'node%d' % i: build_tree(width, depth - 1) for i in range(width)}
+
+
+def bench_getattr(number):
+    C.clear()
+    conf = C()
+    conf.update(build_tree(8, 3))
+    conf['model'] = {'lr': 0.1, 'batch': 128}
+
+    class Plain():
+        pass
+    plain = Plain()
+    plain.model = Plain()
+    plain.model.lr = 0.1
+
+    results = {
+        'plain attribute': timeit.timeit(lambda: plain.model.lr, number=number) / number,
+        'C.get().model.lr': timeit.timeit(lambda: C.get().model.lr, number=number) / number,
+        'C.get()[\'model\'][\'lr\']': timeit.timeit(lambda: C.get()['model']['lr'], number=number) / number,
+        'C.get().at(\'model.lr\')': timeit.timeit(lambda: C.get().at('model.lr'), number=number) / number,
+        'C.get().flatten() (4098 leaves)': timeit.timeit(lambda: C.get().flatten(), number=max(1, number // 1000)) / max(1, number // 1000),
+    }
+    C.clear()
+    return results
+
+
+def safe_load(filename):
+    with open(filename, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def bench_load(number):
+    number = max(1, number // 10000)
+    temp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for width in (4, 8, 12):
+            filename = os.path.join(temp_dir, 'config%d.yaml' % width)
+            with open(filename, 'w') as f:
+                yaml.dump(build_tree(width, 3), f, default_flow_style=False)
+            cache_dir = os.path.join(temp_dir, 'cache%d' % width)
+            load_yaml(filename, cache_dir=cache_dir)
+
+            label = '%d keys' % width ** 4
+            results[label + ' yaml.safe_load'] = timeit.timeit(lambda: safe_load(filename), number=number) / number
+            results[label + ' cold'] = timeit.timeit(lambda: load_yaml(filename), number=number) / number
+            results[label + ' warm'] = timeit.timeit(lambda: load_yaml(filename, cache_dir=cache_dir), number=number) / number
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def bench_fragments(number):
+    number = max(1, number // 10000)
+    temp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        filenames = []
+        for i in range(30):
+            filename = os.path.join(temp_dir, 'fragment%02d.yaml' % i)
+            with open(filename, 'w') as f:
+                yaml.dump({'fragment%d' % i: build_tree(6, 2)}, f, default_flow_style=False)
+            filenames.append(filename)
+
+        results['30 fragments sequential'] = timeit.timeit(lambda: load_yamls(filenames, max_workers=1), number=number) / number
+        for workers in (4, 8, 16):
+            results['30 fragments %d workers' % workers] = timeit.timeit(lambda: load_yamls(filenames, max_workers=workers), number=number) / number
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def bench_lazy(number):
+    number = max(1, number // 10000)
+    temp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        filename = os.path.join(temp_dir, 'tables.yaml')
+        with open(filename, 'w') as f:
+            yaml.dump({
+                'model': {'lr': 0.1, 'batch': 128},
+                'class_weights': {'class%d' % i: 1.0 / (i + 1) for i in range(20000)},
+                'policy': [[i, 'rotate', 0.5] for i in range(5000)],
+            }, f, default_flow_style=False)
+
+        def load(lazy):
+            C.clear()
+            return C(filename, lazy=lazy)['model']['lr']
+        results['eager C()[\'model\']'] = timeit.timeit(lambda: load(False), number=number) / number
+        results['lazy C()[\'model\']'] = timeit.timeit(lambda: load(True), number=number) / number
+        C.clear()
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def bench_dump(number):
+    number = max(1, number // 10000)
+    C.clear()
+    conf = C()
+    conf.conf.update(build_tree(8, 3))
+    conf['model'] = {'lr': 0.1, 'batch': 128}
+
+    def dump(**kwargs):
+        conf['model']['lr'] *= 0.99
+        return conf.dump(**kwargs)
+    results = {
+        'yaml.dump': timeit.timeit(lambda: yaml.dump(conf.conf, default_flow_style=False), number=number) / number,
+        'dump()': timeit.timeit(dump, number=number) / number,
+        'dump(format=json)': timeit.timeit(lambda: dump(format='json'), number=number) / number,
+        'dump(background=True) caller': timeit.timeit(lambda: dump(background=True), number=number) / number,
+    }
+    C.clear()
+    return results
+
+
+def bench_parser(number):
+    number = max(1, number // 10000)
+    temp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        filename = os.path.join(temp_dir, 'config.yaml')
+        with open(filename, 'w') as f:
+            yaml.dump(build_tree(6, 3), f, default_flow_style=False)
+
+        def parse(lazy, deferred=False):
+            C.clear()
+            parser = ConfigArgumentParser(filenames=filename, lazy=lazy, deferred=deferred)
+            return parser.parse_args(args=['-c', filename, '--node0-node1-node2-leaf3', '10', '--node5-node5-node5-leaf5', '7'])
+        results['%d keys ConfigArgumentParser' % 6 ** 4] = timeit.timeit(lambda: parse(False), number=number) / number
+        results['%d keys ConfigArgumentParser lazy' % 6 ** 4] = timeit.timeit(lambda: parse(True), number=number) / number
+        results['%d keys ConfigArgumentParser deferred' % 6 ** 4] = timeit.timeit(lambda: parse(False, True), number=number) / number
+        C.clear()
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def bench_interpolation(number):
+    # a chain (each key references the previous one) and a fan-out (every key references one base key)
+    number = max(1, number // 20000)
+    results = {}
+    for size in (1000, 4000):
+        tree = {'chain': {'k0': 1}, 'fan': {'base': 1}}
+        tree['chain'].update(('k%d' % i, '${chain.k%d + 1}' % (i - 1)) for i in range(1, size))
+        tree['fan'].update(('f%d' % i, '${fan.base * 2}') for i in range(size))
+
+        def load():
+            C.clear()
+            conf = C(interpolate=True)
+            conf.conf = copy.deepcopy(tree)
+            return conf
+        results['%d chained + %d fan-out refs, load' % (size, size)] = timeit.timeit(load, number=number) / number
+        conf = load()
+        results['%d chained refs, override head' % size] = timeit.timeit(
+            lambda: conf.update({'chain': {'k0': 2}}), number=number) / number
+        results['%d fan-out refs, override base' % size] = timeit.timeit(
+            lambda: conf.update({'fan': {'base': 2}}), number=number) / number
+        results['%d refs, override unrelated key' % size] = timeit.timeit(
+            lambda: conf.update({'other': 1}), number=number) / number
+    C.clear()
+    return results
+
+
+def bench_meter(number):
+    import torch
+    from theconf.meter import AverageMeter
+    number = max(1, number // 100)
+    keys = ['metric%d' % i for i in range(32)]
+    values = {key: torch.rand(1) for key in keys}
+
+    # the previous layout: a pair of 1-element buffers per key
+    sums = {key: torch.zeros(1) for key in keys}
+    counts = {key: torch.zeros(1, dtype=torch.int32) for key in keys}
+
+    def per_key_updates():
+        for key, value in values.items():
+            sums[key] += value * 1
+            counts[key] += 1
+
+    def per_key_get():
+        return {key: sums[key].item() / counts[key].item() for key in keys}
+
+    meter = AverageMeter(*keys)
+    quantile_meter = AverageMeter(*keys, quantiles={key: (0.5, 0.95, 0.99) for key in keys},
+                                  ema={key: 0.99 for key in keys})
+    window_meter = AverageMeter(*keys, windows={key: (10, 100) for key in keys}, ema={key: 0.99 for key in keys})
+    results = {
+        '32 keys per-key updates': timeit.timeit(per_key_updates, number=number) / number,
+        '32 keys AverageMeter.updates': timeit.timeit(lambda: meter.updates(values), number=number) / number,
+        '32 keys AverageMeter.updates with quantiles and ema': timeit.timeit(
+            lambda: quantile_meter.updates(values), number=number) / number,
+        '32 keys AverageMeter.updates with windows and ema': timeit.timeit(
+            lambda: window_meter.updates(values), number=number) / number,
+        '32 keys per-key get': timeit.timeit(per_key_get, number=number) / number,
+        '32 keys AverageMeter.get': timeit.timeit(meter.get, number=number) / number,
+        '32 keys AverageMeter.get with quantiles and ema': timeit.timeit(quantile_meter.get, number=number) / number,
+        '32 keys AverageMeter.get with windows and ema': timeit.timeit(window_meter.get, number=number) / number,
+    }
+    return results
+
+
+def bench_threads(number):
+    # readers check that both halves of a pair always match while a writer keeps publishing new versions
+    import threading
+    C.clear()
+    config = C()
+    config['pair'] = {'a': 0, 'b': 0}
+    config.conf.update(build_tree(8, 3))
+    config.snapshot()
+    number = max(1, number // 10)
+
+    def run(readers, write_interval):
+        latencies, torn, stop = [], [], threading.Event()
+
+        def read():
+            local = []
+            for _ in range(number // readers):
+                start = timeit.default_timer()
+                snapshot = config.snapshot()
+                a, b = snapshot.pair.a, snapshot.pair.b
+                local.append(timeit.default_timer() - start)
+                if a != b:
+                    torn.append((a, b))
+            latencies.extend(local)
+
+        def write():
+            i = 0
+            while not stop.wait(write_interval):
+                i += 1
+                config.update({'pair': {'a': i, 'b': i}})
+
+        writer = threading.Thread(target=write) if write_interval else None
+        threads = [threading.Thread(target=read) for _ in range(readers)]
+        for thread in threads + ([writer] if writer else []):
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+        if writer:
+            writer.join()
+        if torn:
+            raise AssertionError('%d torn reads' % len(torn))
+        latencies.sort()
+        return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+    results = {}
+    for readers, write_interval in ((1, None), (8, None), (8, 0.001)):
+        name = '%d readers%s' % (readers, ' + writer' if write_interval else '')
+        p50, p99 = run(readers, write_interval)
+        results['snapshot read p50, %s' % name] = p50
+        results['snapshot read p99, %s' % name] = p99
+    C.clear()
+    return results
+
+
+BENCHMARKS = {
+    'getattr': bench_getattr,
+    'load': bench_load,
+    'fragments': bench_fragments,
+    'lazy': bench_lazy,
+    'dump': bench_dump,
+    'parser': bench_parser,
+    'interpolation': bench_interpolation,
+    'meter': bench_meter,
+    'threads': bench_threads,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--number', type=int, default=100000)
+    parsed_args = parser.parse_args()
+
+    for name in parsed_args.names or sorted(BENCHMARKS.keys()):
+        print('[%s]' % name)
+        for key, elapsed in BENCHMARKS[name](parsed_args.number).items():
+            print('  %-40s %12.3f us/op' % (key, elapsed * 1e6))
@@ -1,14 +1,33 @@
 # -*- coding: utf-8 -*-
 import os
 import datetime
+import json
+import multiprocessing
+import subprocess
+import sys
 import pytest
+import yaml
 
-from theconf.config import Config
+from theconf.config import Config, update_dict, load_yaml, load_yaml_chunk, index_yaml, read_git_info, read_git_info_fast
 
 FIXTURE_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
     'datas',
 )
+IMPORT_TIME_BUDGET_US = 200000
+
+
+def import_time(module):
+    # cumulative microseconds per module reported by `python -X importtime`
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stderr=subprocess.PIPE, check=True, universal_newlines=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
 
 
 def test_singletone():
@@ -65,6 +84,50 @@ def test_update_and_dump(datafiles):
     Config.clear()
 
 
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'arguments_complex.yaml')
+)
+def test_dump_cache(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+
+    assert config.dump() == yaml.dump(config.conf, default_flow_style=False)
+    fragments = {key: fragment for key, (_, fragment) in config._dump_cache.items()}
+
+    config['hparams']['weight_decay'] = 0.1
+    assert config.dump() == yaml.dump(config.conf, default_flow_style=False)
+    assert config._dump_cache['train'][1] is fragments['train']
+    assert config._dump_cache['hparams'][1] != fragments['hparams']
+
+    assert json.loads(config.dump(format='json')) == config.conf
+    config['name'] = u'가나다라 ' * 30
+    assert yaml.safe_load(config.dump()) == config.conf
+    with pytest.raises(ValueError):
+        config.dump(format='unknown')
+
+    Config.clear()
+
+
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'arguments_complex.yaml')
+)
+def test_dump_background(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+
+    future = config.dump(filenames[0], background=True)
+    config['train']['batch_size'] = 1
+    dump_string = future.result()
+    assert yaml.safe_load(dump_string)['train']['batch_size'] == 128
+    with open(filenames[0], 'r') as f:
+        assert f.read() == dump_string
+    assert os.listdir(os.path.dirname(filenames[0])) == ['arguments_complex.yaml']
+
+    Config.clear()
+
+
 @pytest.mark.filterwarnings("ignore:MarkInfo")
 @pytest.mark.datafiles(
     os.path.join(FIXTURE_DIR, 'configs', 'basic.yaml')
@@ -90,6 +153,16 @@ def test_flatten(datafiles):
     assert p['tar'] == 'test'
     assert p['var'] == 'variation'
 
+
+    # nested writes that bypass Config are seen too
+    config.flatten()
+    config['foo']['bar'] = {'test': 10}
+    config['foo']['new'] = 3
+    assert config.flatten('foo') == {'bar-test': 10, 'baz': 2, 'new': 3}
+    assert config.flatten()['foo-bar-test'] == 10
+    assert list(config.leaves('foo')) == [(('foo', 'bar', 'test'), 10), (('foo', 'baz'), 2), (('foo', 'new'), 3)]
+    assert config.at('foo.bar.test') == 10
+
     Config.clear()
 
 
@@ -122,6 +195,51 @@ def test_git_info():
     Config.clear()
 
 
+def test_git_info_fast(tmpdir):
+    path = str(tmpdir)
+    def run(*args):
+        subprocess.check_call(('git', '-C', path, '-c', 'user.name=test', '-c', 'user.email=test@test') + args)
+    run('init', '-q', '-b', 'main')
+    run('remote', 'add', 'origin', 'https://github.com/wbaek/theconf.git')
+    run('commit', '-q', '--allow-empty', '-m', 'first commit')
+
+    expected = read_git_info(path)
+    git_info = read_git_info_fast(path)
+    assert git_info['remote'] == expected['remote'] == 'https://github.com/wbaek/theconf.git'
+    assert git_info['branch'] == expected['branch'] == 'main'
+    assert git_info['commit'] == expected['commit']
+
+    run('pack-refs', '--all')
+    run('gc', '-q')
+    git_info = read_git_info_fast(path)
+    assert git_info['commit']['hash'] == expected['commit']['hash']
+
+    assert read_git_info_fast(str(tmpdir.join('not_exists'))) is None
+
+
+def test_git_info_background():
+    config = Config(skip_git_info=False, git_mode='background')
+    if read_git_info('./') is not None:
+        assert config['_git'] == read_git_info('./')
+    config.dump()
+    assert config._git_future is None
+
+    Config.clear()
+
+
+def test_git_info_background_chdir(tmpdir, monkeypatch):
+    # the working directory is resolved when collection starts, not when the worker gets to it
+    from theconf import config as theconf_config
+    cwd = os.getcwd()
+    monkeypatch.setattr(theconf_config, 'read_git_info', lambda path: {'path': path})
+    monkeypatch.chdir(str(tmpdir))
+    config = Config(skip_git_info=False, git_mode='background')
+    os.chdir(cwd)
+    assert config['_git'] == {'path': str(tmpdir)}
+
+    Config.clear()
+
+
 def test_timestamp():
     config = Config(skip_timestamp=False)
 
@@ -147,6 +265,446 @@ def test_namedtuple(datafiles):
     config.clear()
 
 
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'basic.yaml')
+)
+def test_namedtuple_cache(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+
+    foo = config.foo
+    assert foo.bar == 1
+    assert config.foo is foo
+
+    config['foo'] = {'bar': 10, 'baz': 20}
+    assert config.foo is not foo
+    assert config.foo.bar == 10
+
+    config['tar'] = 'test'
+    assert config.tar == 'test'
+
+    config.conf = {'foo': {'bar': 100}}
+    assert config.foo.bar == 100
+    with pytest.raises(AttributeError):
+        _ = config.tar
+
+    Config.clear()
+
+
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'basic.yaml')
+)
+def test_changes(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+
+    revision = config.revision
+    assert config.changes(revision) == []
+
+    config['tar'] = 'test'
+    assert config.changes(revision) == ['tar']
+
+    revision = config.update({'foo': {'bar': 10, 'qux': {'quux': 1}}})
+    assert config['foo'] == {'bar': 10, 'baz': 2, 'qux': {'quux': 1}}
+    assert config.changes(revision - 1) == ['foo.bar', 'foo.qux.quux']
+    assert config.changes(revision) == []
+
+    config['foo']['baz'] = 3
+    config.touch('foo.baz')
+    assert config.changes(revision) == ['foo.baz']
+
+    config.dump()
+    assert config.changes(revision) == ['_version', 'foo.baz']
+
+    Config.clear()
+
+
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'basic.yaml')
+)
+def test_namedtuple_incremental(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+    config['tar'] = {'var': 1}
+
+    foo, tar = config.foo, config.tar
+    config['tar'] = {'var': 2}
+    assert config.foo is foo
+    assert config.tar is not tar
+    assert config.tar.var == 2
+
+    config['foo']['bar'] = 10
+    config.touch('foo.bar')
+    assert config.foo.bar == 10
+
+    # subtrees handed out as dicts are rebuilt without touch()
+    tar = config.tar
+    config['foo']['bar'] = 5
+    assert Config.get().foo.bar == 5
+    assert config.tar is tar
+    Config.get().get('foo')['baz'] = 6
+    assert config.foo.baz == 6
+    update_dict(Config.get().conf, {'foo': {'bar': 7}, 'tar': {'var': 3}})
+    assert config.foo.bar == 7
+    assert config.tar.var == 3
+    config.at('foo')['bar'] = 8
+    assert config.foo.bar == 8
+
+    Config.clear()
+
+    # dicts handed out before the view is built, and held across attribute reads
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+    config['tar'] = 'test'
+    foo = config['foo']
+    assert config.foo.bar == 1
+    foo['bar'] = 99
+    assert config.foo.bar == 99
+    assert config.tar == 'test'
+    assert 'tar' in config.__dict__ and 'foo' not in config.__dict__
+
+    conf = config.conf
+    assert config.foo.baz == 2
+    conf['foo']['baz'] = 77
+    conf['tar'] = 'changed'
+    conf['new'] = {'x': 1}
+    assert config.foo.baz == 77
+    assert config.tar == 'changed'
+    assert config.new.x == 1
+    conf['new']['x'] = 2
+    assert config.new.x == 2
+
+    # a detached dict no longer keeps its key from being pinned
+    config.conf = {'foo': {'bar': 1}}
+    assert config.foo.bar == 1
+    assert 'foo' in config.__dict__
+
+    # reads of leaves through the index do not hand the subtree out
+    config['foo'] = {'bar': 2}
+    assert config.at('foo.bar') == 2 and list(config.leaves('foo')) == [(('foo', 'bar'), 2)]
+    assert config.foo.bar == 2
+    assert 'foo' in config.__dict__
+
+    Config.clear()
+
+
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'basic.yaml')
+)
+def test_load_yaml_cache(datafiles, tmpdir):
+    filenames = [str(f) for f in datafiles.listdir()]
+    cache_dir = str(tmpdir.join('cache'))
+
+    assert load_yaml(filenames[0], cache_dir=cache_dir) == {'foo': {'bar': 1, 'baz': 2}}
+    assert len(os.listdir(cache_dir)) == 1
+    assert load_yaml(filenames[0], cache_dir=cache_dir) == {'foo': {'bar': 1, 'baz': 2}}
+
+    with open(filenames[0], 'w') as f:
+        f.write('foo:\n    bar: 3\n')
+    assert load_yaml(filenames[0], cache_dir=cache_dir) == {'foo': {'bar': 3}}
+    assert len(os.listdir(cache_dir)) == 1
+
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True, cache_dir=cache_dir)
+    assert config['foo']['bar'] == 3
+
+    Config.clear()
+
+
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'arguments_complex.yaml')
+)
+def test_lazy(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True, lazy=True)
+
+    assert sorted(config._lazy.keys()) == ['base', 'eval', 'hparams', 'train']
+    assert 'train' in config
+    assert config['train']['batch_size'] == 128
+    assert config.eval.batch_size == 512
+    assert sorted(config._lazy.keys()) == ['base', 'hparams']
+
+    expected = load_yaml(filenames[0])
+    expected['_version'] = 1
+    assert config.conf == expected
+    assert list(config.conf.keys()) == list(expected.keys())
+    assert not config._lazy
+
+    Config.clear()
+
+
+def test_lazy_fallback(tmpdir):
+    filename = str(tmpdir.join('anchor.yaml'))
+    with open(filename, 'w') as f:
+        f.write('base: &base\n    lr: 0.1\ntrain:\n    <<: *base\n')
+    assert index_yaml(filename) is None
+
+    config = Config(filename, skip_timestamp=True, skip_git_info=True, lazy=True)
+    assert not config._lazy
+    assert config['train']['lr'] == 0.1
+
+    Config.clear()
+
+    filename = str(tmpdir.join('flow.yaml'))
+    with open(filename, 'w') as f:
+        f.write('foo: {bar: 1,\nbaz: 2}\n')
+    assert index_yaml(filename) is None
+
+    filename = str(tmpdir.join('quoted.yaml'))
+    with open(filename, 'w') as f:
+        f.write('# comment\n"foo bar": 1\ntrue: 2\nbaz:\n  - 1\n\n  - 2\n')
+    assert sorted(index_yaml(filename).keys(), key=str) == [True, 'baz', 'foo bar']
+
+    # a quoted scalar going on at column 0 is not a key
+    filename = str(tmpdir.join('multiline.yaml'))
+    with open(filename, 'w') as f:
+        f.write('a: "foo\nbar: baz"\nc: 1\n')
+    assert index_yaml(filename) is None
+    config = Config(filename, skip_timestamp=True, skip_git_info=True, lazy=True)
+    assert config['a'] == 'foo bar: baz'
+    assert 'bar' not in config
+    Config.clear()
+
+    # a chunk that does not parse alone is read from the whole file
+    filename = str(tmpdir.join('chunk.yaml'))
+    with open(filename, 'w') as f:
+        f.write('a: 1\nb: 2\n')
+    index = index_yaml(filename)
+    assert load_yaml_chunk(filename, index['a'][0], index['b'][0] + 3, index['a'][2], key='a') == {'a': 1}
+
+
+def _attached_value(name):
+    Config.clear()
+    config = Config.attach(name)
+    pending = sorted(config._lazy.keys())
+    value = config['train']['batch_size']
+    Config.clear()
+    return pending, value
+
+
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'arguments_complex.yaml')
+)
+def test_share(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+    config['train']['batch_size'] = 256
+    name = config.share()
+
+    pool = multiprocessing.get_context('fork').Pool(2)
+    try:
+        results = pool.map(_attached_value, [name] * 2)
+    finally:
+        pool.close()
+        pool.join()
+    assert results == [(['_version', 'base', 'eval', 'hparams', 'train'], 256)] * 2
+
+    expected = dict(config.conf)
+    Config.clear()
+    attached = Config.attach(name)
+    assert attached.conf == expected
+    assert list(attached.conf.keys()) == list(expected.keys())
+    Config.clear()
+
+    config.unshare()
+
+
+def test_share_unrelated_process(tmpdir):
+    # a process that is not a child of the owner attaches by name; its exit leaves the segment to the owner
+    config = Config()
+    config['train'] = {'batch_size': 256}
+    name = config.share()
+    script = 'from theconf import Config; print(Config.attach(%r)["train"]["batch_size"])' % name
+    output = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+                            universal_newlines=True, env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(FIXTURE_DIR))))
+    assert output.stdout.strip() == '256'
+    assert 'leaked' not in output.stderr
+
+    Config.clear()
+    assert Config.attach(name)['train'] == {'batch_size': 256}
+    Config.clear()
+
+    # unshare tolerates a segment someone else already unlinked
+    from multiprocessing import shared_memory
+    shared_memory.SharedMemory(name=name).unlink()
+    config.unshare()
+    Config.clear()
+
+
+def test_import_time():
+    times = import_time('theconf')
+    for module in ('yaml', 'git', 'torch', 'mlflow', 'multiprocessing.shared_memory', 'concurrent.futures'):
+        assert module not in times
+    assert times['theconf'] < IMPORT_TIME_BUDGET_US
+
+
+def test_reload(tmpdir, monkeypatch):
+    import theconf.config
+    base, extra = tmpdir.join('base.yaml'), tmpdir.join('extra.yaml')
+    base.write('model:\n  lr: 0.1\n  depth: 18\ntrain:\n  epoch: 3\n')
+    extra.write('train:\n  epoch: 5\n')
+    config = Config([str(base), str(extra)], skip_timestamp=True, skip_git_info=True)
+    config['train']['batch'] = 64
+    assert config.model.lr == 0.1
+
+    notified = []
+    config.subscribe(lambda path, old, new: notified.append((path, old, new)), prefix='model')
+    assert config.reload() == {}
+
+    loaded = []
+    monkeypatch.setattr(theconf.config, 'load_yaml', lambda filename: loaded.append(filename) or load_yaml(filename))
+    base.write('model:\n  lr: 0.01\n  depth: 18\ntrain:\n  epoch: 4\n')
+    changed = config.reload()
+    # only the edited file is parsed, extra.yaml still wins for train.epoch and runtime values stay
+    assert loaded == [str(base)]
+    assert changed == {'model.lr': (0.1, 0.01)}
+    assert notified == [('model.lr', 0.1, 0.01)]
+    assert config.model.lr == 0.01
+    assert config['train'] == {'epoch': 5, 'batch': 64}
+    assert config.changes(config.revision - 1) == ['model.lr']
+
+    # a removed key stays, a broken file keeps the last good tree
+    base.write('model:\n  lr: 0.01\n')
+    assert config.reload() == {}
+    base.write('model: [\n')
+    assert config.reload() == {}
+    assert config.model.depth == 18
+    Config.clear()
 
 
+def test_reload_first_edit(tmpdir):
+    # an edit made before the first reload() is applied
+    base = tmpdir.join('base.yaml')
+    base.write('model:\n  lr: 0.1\n  depth: 18\n')
+    for lazy in (False, True):
+        base.write('model:\n  lr: 0.1\n  depth: 18\n')
+        config = Config(str(base), lazy=lazy)
+        assert config['model']['lr'] == 0.1
+        base.write('model:\n  lr: 0.01\n  depth: 18\n')
+        assert config.reload() == {'model.lr': (0.1, 0.01)}
+        assert config['model'] == {'lr': 0.01, 'depth': 18}
+        assert config.reload() == {}
+        Config.clear()
+
+
+def test_watch(tmpdir):
+    import threading
+    filename = tmpdir.join('base.yaml')
+    filename.write('model:\n  lr: 0.1\n')
+    config = Config(str(filename), skip_timestamp=True, skip_git_info=True)
+    reloaded = threading.Event()
+    config.subscribe(lambda path, old, new: reloaded.set())
+    config.watch(interval=0.01, debounce=0.05)
+    try:
+        filename.write('model:\n  lr: 0.001\n')
+        assert reloaded.wait(5)
+        assert config.model.lr == 0.001
+    finally:
+        config.unwatch()
+    Config.clear()
 
+
+def test_snapshot():
+    import threading
+    config = Config()
+    config['pair'] = {'a': 0, 'b': 0, 'list': [0]}
+    config['other'] = {'c': 1}
+    snapshot = config.snapshot()
+    assert snapshot.revision == config.revision
+    assert snapshot.pair.a == snapshot['pair']['b'] == 0
+    assert snapshot['pair']['list'] == (0,)
+    with pytest.raises(TypeError):
+        snapshot['pair']['a'] = 1
+    with pytest.raises(TypeError):
+        snapshot.pair.a = 1
+
+    # writes publish a new snapshot, unchanged subtrees are shared and old snapshots stay as they were
+    config.update({'pair': {'a': 1, 'b': 1}})
+    assert config.snapshot().pair.a == 1 and snapshot.pair.a == 0
+    assert config.snapshot().other is snapshot.other
+
+    torn, stop = [], threading.Event()
+
+    def read():
+        revision = 0
+        while not stop.is_set():
+            current = config.snapshot()
+            if current.pair.a != current.pair.b or current.revision < revision:
+                torn.append(current)
+            revision = current.revision
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for i in range(2, 500):
+        config.update({'pair': {'a': i, 'b': i}})
+    stop.set()
+    for reader in readers:
+        reader.join()
+    assert not torn
+    assert config.snapshot().pair.a == 499
+    Config.clear()
+
+
+def test_pickle():
+    import copy
+    import pickle
+    config = Config()
+    config['pair'] = {'a': 0, 'b': 0}
+    config['lr'] = 0.1
+    config.snapshot()
+    config.dump(background=True).result()
+    assert config.pair.a == 0 and config.lr == 0.1
+
+    # locks, executors and published snapshots stay with the process, the tree goes to the child
+    for restored in (pickle.loads(pickle.dumps(config)), copy.deepcopy(config)):
+        assert restored['pair'] == {'a': 0, 'b': 0}
+        restored.update({'pair': {'a': 1}})
+        assert restored.snapshot().pair.a == 1
+        assert restored.get('pair')['a'] == 1
+        assert restored.pair.a == 1 and restored.lr == 0.1
+        assert config['pair']['a'] == 0
+    Config.clear()
+
+
+def test_at_and_leaves():
+    config = Config()
+    config['data'] = {'dict': {'from': 'to'}, 'list': [1, {'a': 2}], '_hidden': 1}
+    config['learning-rate'] = {'base': 0.1}
+    assert config.at('data.dict.from') == config.at('data-dict-from') == config.at(['data', 'dict', 'from']) == 'to'
+    assert config.at('learning-rate.base') == config.at('learning-rate-base') == 0.1
+    assert config.at('data.dict') == {'from': 'to'}
+    assert config.at('data.missing', None) is None
+    with pytest.raises(KeyError):
+        config.at('data.missing')
+
+    assert list(config.leaves('data')) == [(('data', 'dict', 'from'), 'to'), (('data', 'list'), [1, {'a': 2}])]
+    assert [keys for keys, _ in config.leaves('data', private=True)][-1] == ('data', '_hidden')
+    assert config.flatten() == {'data-dict-from': 'to', 'data-list-0': 1, 'data-list-1-a': 2, 'learning-rate-base': 0.1}
+    assert config.flatten('data') == {'dict-from': 'to', 'list-0': 1, 'list-1-a': 2}
+
+    # writes through Config refresh the index of their subtree only
+    index = config._flat['learning-rate']
+    config.update({'data': {'dict': {'to': 'from'}}})
+    assert config.at('data.dict.to') == 'from'
+    assert config._flat['learning-rate'] is index
+    config['data'] = {'replaced': True}
+    assert config.at('data.dict', None) is None
+    assert config.at('data.replaced') is True
+
+    # nested dicts replaced in place are not read, or written, through the old index
+    config['data'] = {'dict': {'from': 'to'}}
+    assert config.at('data.dict.from') == 'to'
+    config['data']['dict'] = {'other': 2}
+    assert config.at('data.dict.from', None) is None
+    assert config.at('data.dict.other') == 2
+    config['data']['dict'] = {'other': 3}
+    assert config.at('data.dict.other') == 3
+    parent, key = config.locate('data.dict.other')
+    parent[key] = 4
+    assert config['data']['dict'] == {'other': 4}
+    Config.clear()
@@ -126,6 +126,15 @@ def test_arguments_complex(datafiles):
 
     Config.clear()
 
+    parser = ConfigArgumentParser(filenames=filenames[0])
+    args = parser.parse_args(args=['--train-batch_size', '64', '--base-data_list', '5', '6'])
+    assert args.train_batch_size == 64
+    assert Config.get_instance()['train'] == {'batch_size': 64, 'lr': 0.0001}
+    assert Config.get_instance()['base']['data_list'] == [5, 6]
+    assert 'train_batch_size' not in Config.get_instance()
+
+    Config.clear()
+
     assert True
 
 
@@ -179,3 +188,64 @@ def test_arguments_simple_lazy(datafiles):
     Config.clear()
 
 
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'arguments.yaml')
+)
+def test_arguments_changes(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    parser = ConfigArgumentParser(filenames=filenames[0])
+    revision = Config.get_instance().revision
+    _ = parser.parse_args(args=['-c', filenames[0], '--foo', 'value'])
+
+    assert Config.get_instance().changes(revision) == ['config', 'foo']
+
+    Config.clear()
+
+
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'arguments_complex.yaml')
+)
+def test_arguments_deferred(datafiles, capsys):
+    filenames = [str(f) for f in datafiles.listdir()]
+    parser = ConfigArgumentParser(filenames=filenames[0], deferred=True)
+    args = parser.parse_args(args=['--train-lr', '0.1', '--hparams-data_format=channels_last'])
+
+    assert args.train_lr == 0.1
+    assert args.hparams_data_format == 'channels_last'
+    assert not hasattr(args, 'train_batch_size')
+    assert Config.get_instance()['train'] == {'batch_size': 128, 'lr': 0.1}
+    assert Config.get_instance()['hparams']['data_format'] == 'channels_last'
+
+    Config.clear()
+
+    parser = ConfigArgumentParser(filenames=filenames[0], deferred=True)
+    with pytest.raises(SystemExit):
+        _ = parser.parse_args(args=['--train-lr', 'not_float'])
+    Config.clear()
+
+    # abbreviations resolve as with every key registered
+    parser = ConfigArgumentParser(filenames=filenames[0], deferred=True)
+    args = parser.parse_args(args=['--train-l', '0.1', '--train-b=64'])
+    assert args.train_lr == 0.1
+    assert Config.get_instance()['train'] == {'batch_size': 64, 'lr': 0.1}
+    Config.clear()
+
+    parser = ConfigArgumentParser(filenames=filenames[0], deferred=True)
+    with pytest.raises(SystemExit):
+        _ = parser.parse_args(args=['--train-', '0.1'])
+    assert 'ambiguous option' in capsys.readouterr().err
+    Config.clear()
+
+    parser = ConfigArgumentParser(filenames=filenames[0], deferred=True, allow_abbrev=False)
+    with pytest.raises(SystemExit):
+        _ = parser.parse_args(args=['--train-l', '0.1'])
+    Config.clear()
+
+    parser = ConfigArgumentParser(filenames=filenames[0], deferred=True)
+    with pytest.raises(SystemExit):
+        _ = parser.parse_args(args=['--help'])
+    assert '--eval-batch_size EVAL_BATCH_SIZE' in capsys.readouterr().out
+
+    Config.clear()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import pytest
+
+from theconf import Config
+from theconf import ConfigArgumentParser
+from theconf.interpolation import InterpolationError
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'datas',
+)
+
+
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'interpolation.yaml')
+)
+def test_interpolation(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    for lazy in (False, True):
+        config = Config(filenames[0], lazy=lazy, interpolate=True)
+        assert config['log'] == './runs/exp1/exp1.log'
+        assert config.train.lr == 0.1
+        assert config.conf == {
+            'run': {'name': 'exp1', 'dir': './runs/exp1'},
+            'train': {'batch': 256, 'lr': 0.1, 'epochs': 90, 'warmup': 5, 'amp': False},
+            'eval': {'train': {'batch': 256, 'lr': 0.1, 'epochs': 90, 'warmup': 5, 'amp': False},
+                     'paths': ['./runs/exp1/best.pth', 'last.pth']},
+            'log': './runs/exp1/exp1.log',
+            '_version': 1,
+        }
+        # a referenced subtree is copied, not shared
+        assert config['eval']['train'] is not config['train']
+        assert config.resolve('${run.dir}/step-${train.epochs * 10}') == './runs/exp1/step-900'
+        Config.clear()
+
+
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'interpolation.yaml')
+)
+def test_interpolation_overrides(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    parser = ConfigArgumentParser(filenames=filenames[0], interpolate=True)
+    args = parser.parse_args(args=['-c', filenames[0], '--train-batch', '512', '--run-name', 'exp2'])
+    config = Config.get_instance()
+    assert (args.train_lr, args.train_amp, args.run_dir) == (0.2, True, './runs/exp2')
+    assert config['eval']['paths'][0] == './runs/exp2/best.pth'
+    assert config['log'] == './runs/exp2/exp2.log'
+
+    # only the dependents of a written key are evaluated again
+    revision = config.revision
+    config.update({'train': {'epochs': 180}})
+    assert config.changes(since=revision) == ['eval.train', 'train.epochs', 'train.warmup']
+    assert config['train']['warmup'] == 10
+
+    # a derived key that is written directly is overridden for good
+    config['run']['dir'] = '/data'
+    config.touch('run.dir')
+    config.update({'run': {'name': 'exp3'}})
+    assert config['run']['dir'] == '/data'
+    assert config['log'] == '/data/exp3.log'
+
+    # and a written template is evaluated
+    config.update({'train': {'epochs': '${train.batch // 16}'}})
+    assert (config['train']['epochs'], config['train']['warmup']) == (32, 1)
+    Config.clear()
+
+
+def test_interpolation_errors(tmpdir):
+    for content, message in [
+            ('a: ${b}\nb: ${c.d}\nc: {d: "${a}"}\n', 'cycle in config references: '),
+            ('a: ${b}\n', 'a: unknown reference'),
+            ('a: ${__import__("os")}\n', 'unsupported expression'),
+            ('a: ${b +}\nb: 1\n', 'invalid expression')]:
+        filename = str(tmpdir.join('config.yaml'))
+        with open(filename, 'w') as f:
+            f.write(content)
+        with pytest.raises(InterpolationError) as e:
+            Config(filename, interpolate=True)
+        assert message in str(e.value)
+        Config.clear()
+
+    config = Config(interpolate=True)
+    config.update({'a': 1, 'b': '${a}'})
+    with pytest.raises(InterpolationError):
+        config.update({'a': '${b}'})
+    Config.clear()
+
+
+def test_interpolation_chain():
+    # deeper than the recursion limit, evaluated once per key
+    size = 5000
+    config = Config(interpolate=True)
+    chain = {'k0': 1}
+    chain.update(('k%d' % i, '${chain.k%d + 1}' % (i - 1)) for i in range(1, size))
+    config['chain'] = chain
+    assert config.at('chain.k%d' % (size - 1)) == size
+
+    revision = config.revision
+    config.update({'chain': {'k0': 2}})
+    assert config.at('chain.k%d' % (size - 1)) == size + 1
+    assert len(config.changes(since=revision)) == size
+
+    # attached processes keep the graph
+    name = config.share()
+    Config.clear()
+    attached = Config.attach(name)
+    attached.update({'chain': {'k%d' % (size - 2): 0}})
+    assert attached.at('chain.k%d' % (size - 1)) == 1
+    assert attached.at('chain.k0') == 2
+
+    # and so do pickled ones, without the shared memory
+    restored = pickle.loads(pickle.dumps(attached))
+    assert '_shared' not in restored.__dict__
+    restored.update({'chain': {'k0': 5}})
+    assert restored.at('chain.k%d' % (size - 3)) == size + 2
+    assert restored.at('chain.k%d' % (size - 1)) == 1
+    Config.clear()
+    config.unshare()
+
+
+def test_interpolation_escape(tmpdir):
+    filename = str(tmpdir.join('config.yaml'))
+    with open(filename, 'w') as f:
+        f.write('name: exp1\ncmd: echo $${HOME}/${name}\nraw: ${HOME}\n')
+
+    # off by default: templates stay as written
+    config = Config(filename)
+    assert config['cmd'] == 'echo $${HOME}/${name}'
+    assert config['raw'] == '${HOME}'
+    assert config.resolve('${name}/log') == 'exp1/log'
+    config.update({'name': 'exp2'})
+    assert config['cmd'] == 'echo $${HOME}/${name}'
+    Config.clear()
+
+    with open(filename, 'w') as f:
+        f.write('name: exp1\ncmd: echo $${HOME}/${name}\nliteral: $${HOME}\n')
+    config = Config(filename, interpolate=True)
+    assert config['cmd'] == 'echo ${HOME}/exp1'
+    assert config['literal'] == '${HOME}'
+    # a literal left by an escape is not read as a template again
+    config.touch('literal')
+    config['name'] = 'exp2'
+    assert (config['cmd'], config['literal']) == ('echo ${HOME}/exp2', '${HOME}')
+    Config.clear()
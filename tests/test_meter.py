@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import subprocess
+import csv as csv_module
+import json
+import math
 import pytest
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
 from theconf.meter import AverageMeter
+from theconf.sinks import JsonlSink, CsvSink
 
 def test_average_meta_to_device():
     if torch.cuda.is_available():
@@ -71,3 +78,232 @@ def test_average_meta_not_exist_key():
     meter = AverageMeter('key1', 'key2')
     assert meter['not_exists'] == 0.0
 
+
+def test_average_meta_packed():
+    meter = AverageMeter('key1', 'key2', 'key3')
+    meter.updates({'key1': 2 * torch.ones(1), 'key3': torch.tensor(4, dtype=torch.int64)}, n=2)
+    meter.updates({'key2': 1.0, 'key3': 6.0})
+    meter.update('key2', 3 * torch.ones(1))
+    meter.updates({})
+
+    assert meter._sums.tolist() == [4.0, 4.0, 14.0]
+    assert meter._counts.tolist() == [2, 2, 3]
+    assert meter.get() == {'key1': 2.0, 'key2': 2.0, 'key3': 14.0 / 3}
+
+    state_dict = meter.state_dict()
+    assert list(state_dict.keys()) == ['key1', 'key1_count', 'key2', 'key2_count', 'key3', 'key3_count']
+
+    other = AverageMeter('key1', 'key2', 'key3')
+    other.load_state_dict(state_dict)
+    assert other.get() == meter.get()
+
+    other = other.to(dtype=torch.float64)
+    other.updates({'key1': 4.0})
+    assert other._buffers['key1'].data_ptr() == other._sums.data_ptr()
+    assert other['key1'] == 8.0 / 3
+
+
+def test_average_meta_reset():
+    meter = AverageMeter('key1', 'key2')
+    buffers = dict(meter._buffers)
+    meter.updates({'key1': 2 * torch.ones(1), 'key2': 5 * torch.ones(1)})
+
+    meter.reset(keys=['key2'])
+    assert meter['key1'] == 2
+    assert meter['key2'] == 0.0
+    assert meter.step == 2
+
+    meter.reset(step=10)
+    assert meter['key1'] == 0.0
+    assert meter.step == 10
+    assert all(meter._buffers[key] is buffer for key, buffer in buffers.items())
+    assert meter.state_dict()['key1_count'].tolist() == [0]
+
+    meter.update('key1', 3 * torch.ones(1))
+    meter.log('train', tensorboard=False, keep_best_keys=['key1'])
+    meter.reset()
+    assert meter.get(with_best=True) == {'key1': 0.0, 'key2': 0.0, 'key1_best': 3.0, 'key1_best_step': 10.0}
+
+
+def _average_meta_sync(rank, world_size, init_method, results):
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        meter = AverageMeter('key1', 'key2')
+        meter.update('key1', (rank + 1) * torch.ones(1), n=rank + 1)
+        meter.update('key2', 10 * torch.ones(1))
+
+        results[rank] = (meter.get(reduce=True), meter.get())
+        meter.log('train', tensorboard=False, reduce=True)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_average_meta_sync(tmpdir):
+    world_size = 2
+    init_method = 'file://' + str(tmpdir.join('store'))
+    results = mp.get_context('fork').Manager().dict()
+    mp.start_processes(_average_meta_sync, args=(world_size, init_method, results), nprocs=world_size, start_method='fork')
+
+    # key1: (1 * 1 + 2 * 2) / (1 + 2), key2: (10 + 10) / 2
+    assert results[0][0] == results[1][0] == {'key1': 5.0 / 3, 'key2': 10.0}
+    assert results[1][1] == {'key1': 2.0, 'key2': 10.0}
+
+    meter = AverageMeter('key1')
+    meter.update('key1', 3 * torch.ones(1))
+    assert meter.get(reduce=True) == meter.get()
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_average_meta_log(tmpdir, monkeypatch, background):
+    mlflow = pytest.importorskip('mlflow')
+    from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+
+    monkeypatch.setenv('MLFLOW_ALLOW_FILE_STORE', 'true')
+    mlflow.set_tracking_uri('file://' + str(tmpdir.join('mlruns')))
+    meter = AverageMeter('key1', 'key2', tensorboard_path=str(tmpdir.join('tensorboard')), background=background)
+    with mlflow.start_run() as run:
+        for step in range(5):
+            meter.updates({'key1': step * torch.ones(1), 'key2': 2 * step * torch.ones(1)})
+            meter.log('train', step=step, mlflow=True)
+            meter.reset()
+        meter.close()
+
+    history = mlflow.tracking.MlflowClient().get_metric_history(run.info.run_id, 'train_key2')
+    assert sorted((metric.step, metric.value) for metric in history) == [(step, 2.0 * step) for step in range(5)]
+
+    events = EventAccumulator(str(tmpdir.join('tensorboard', 'train')))
+    events.Reload()
+    assert [(event.step, event.value) for event in events.Scalars('metrics/key1')] == [(step, float(step)) for step in range(5)]
+
+
+def test_average_meta_log_overflow():
+    meter = AverageMeter('key1', background=True, max_queue=1, overflow='drop_newest')
+    meter._queue.put(None)
+    meter._thread.join()
+    meter._queue.put_nowait(None)
+    meter.log('train')
+    assert meter.dropped == 1
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_average_meta_log_file_sinks(tmpdir, background):
+    jsonl = JsonlSink(str(tmpdir.join('metrics.jsonl')), buffer_size=3)
+    csv = CsvSink(str(tmpdir.join('metrics.csv')))
+    meter = AverageMeter('key1', 'key2', sinks=[jsonl, csv], background=background)
+    for step in range(5):
+        meter.updates({'key1': step * torch.ones(1), 'key2': 2 * step * torch.ones(1)})
+        meter.log('train', step=step)
+        meter.reset()
+    if not background:
+        # buffered until three records are pending
+        assert len(tmpdir.join('metrics.jsonl').readlines()) == 3
+        assert not tmpdir.join('metrics.csv').exists()
+    meter.close()
+
+    lines = [json.loads(line) for line in tmpdir.join('metrics.jsonl').readlines()]
+    assert [(line['prefix'], line['step'], line['metrics']) for line in lines] == \
+        [('train', step, {'key1': float(step), 'key2': 2.0 * step}) for step in range(5)]
+
+    rows = list(csv_module.DictReader(tmpdir.join('metrics.csv').open()))
+    assert len(rows) == 10
+    assert [(row['step'], row['key'], float(row['value'])) for row in rows[:2]] == [('0', 'key1', 0.0), ('0', 'key2', 0.0)]
+
+
+def test_average_meta_lazy_sinks():
+    # tensorboard and mlflow are only imported by the sinks that use them
+    code = 'import sys, theconf.meter; print(" ".join(sorted(sys.modules)))'
+    modules = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                             universal_newlines=True).stdout.split()
+    assert 'torch' in modules
+    assert 'mlflow' not in modules
+    assert 'torch.utils.tensorboard' not in modules
+
+
+def test_average_meta_quantiles_and_ema():
+    meter = AverageMeter('loss', 'latency', quantiles={'latency': (0.5, 0.99)}, ema={'loss': 0.5})
+    assert meter.get() == {'loss': 0.0, 'latency': 0.0, 'latency_p50': 0.0, 'latency_p99': 0.0, 'loss_ema': 0.0}
+
+    samples = torch.arange(1, 1001, dtype=torch.float)
+    for sample in samples:
+        meter.updates({'loss': sample.reshape(1), 'latency': sample.reshape(1)})
+    averages = meter.get()
+    # within the sketch's relative accuracy
+    assert averages['latency_p50'] == pytest.approx(500.0, rel=0.02)
+    assert averages['latency_p99'] == pytest.approx(990.0, rel=0.02)
+    assert averages['loss_ema'] == pytest.approx(999.0, rel=1e-3)
+    assert meter['latency_p50'] == averages['latency_p50']
+    assert sum(count for _, count in meter.histogram('latency')) == 1000
+
+    # bias corrected: (0.5 * 2 + 4) / 1.5
+    meter = AverageMeter('key1', ema={'key1': 0.5})
+    meter.update('key1', 2.0)
+    meter.update('key1', 4.0)
+    assert meter['key1_ema'] == pytest.approx(10.0 / 3)
+
+    # reset clears the sketch but the EMA keeps decaying
+    meter = AverageMeter('key1', quantiles={'key1': (0.5,)}, ema={'key1': 0.5})
+    meter.updates({'key1': -3 * torch.ones(1)})
+    meter.reset()
+    assert meter.get() == {'key1': 0.0, 'key1_p50': 0.0, 'key1_ema': -3.0}
+
+    with pytest.raises(ValueError):
+        AverageMeter('key1', quantiles={'key2': (0.5,)})
+
+    # a nan loss does not break the meter and is left out of the quantiles
+    meter = AverageMeter('loss', 'acc', quantiles={'loss': (0.5,)})
+    meter.updates({'loss': torch.tensor([float('nan')]), 'acc': torch.ones(1)})
+    meter.updates({'loss': torch.tensor([float('inf')]), 'acc': torch.ones(1)})
+    meter.update('loss', float('nan'))
+    meter.updates({'loss': 2 * torch.ones(1), 'acc': torch.ones(1)})
+    averages = meter.get()
+    assert math.isnan(averages['loss'])
+    assert averages['acc'] == 1.0
+    assert averages['loss_p50'] == pytest.approx(2.0, rel=0.02)
+    assert sum(count for _, count in meter.histogram('loss')) == 1
+
+
+def test_average_meta_windows():
+    meter = AverageMeter('key1', 'key2', windows={'key1': (2, 3)}, ema={'key1': 0.5})
+    for value in range(1, 6):
+        meter.updates({'key1': value * torch.ones(1), 'key2': torch.ones(1)})
+    meter.update('key1', 10.0, n=2)
+    # epoch, last two and last three updates weighted by n, side by side
+    assert meter.get() == pytest.approx({'key1': 35.0 / 7, 'key2': 1.0, 'key1_ema': meter['key1_ema'],
+                                         'key1_last2': 25.0 / 3, 'key1_last3': 29.0 / 4})
+
+    # windows span resets
+    meter.reset()
+    assert meter['key1'] == 0.0
+    assert meter['key1_last2'] == pytest.approx(25.0 / 3)
+
+    restored = AverageMeter('key1', 'key2', windows={'key1': (2, 3)}, ema={'key1': 0.5})
+    restored.load_state_dict(meter.state_dict())
+    assert restored.get() == meter.get()
+
+
+def test_average_meta_best():
+    meter = AverageMeter('loss', 'accuracy', best_modes={'loss': 'min'})
+    history = [({'loss': 2.0, 'accuracy': 0.5}, 1), ({'loss': 1.0, 'accuracy': 0.9}, 4), ({'loss': 1.5, 'accuracy': 0.7}, 2)]
+    for step, (values, n) in enumerate(history):
+        # sums grow with n, the averages decide
+        for key, value in values.items():
+            meter.update(key, value * torch.ones(1), n=n)
+        meter.log('valid', step=step, tensorboard=False, keep_best_keys=['loss', 'accuracy'])
+        meter.reset()
+    assert meter.get(with_best=True) == pytest.approx({
+        'loss': 0.0, 'accuracy': 0.0, 'loss_best': 1.0, 'loss_best_step': 1.0,
+        'accuracy_best': 0.9, 'accuracy_best_step': 1.0})
+
+    # logging without samples does not replace the best
+    meter.log('valid', step=3, tensorboard=False, keep_best_keys=['loss'])
+    assert meter['loss_best_step'] == 1.0
+
+    # preallocated views: logging never registers new buffers
+    buffers = dict(meter._buffers)
+    meter.update('loss', 0.5 * torch.ones(1))
+    meter.log('valid', step=4, tensorboard=False, keep_best_keys=['loss', 'accuracy'])
+    assert all(meter._buffers[key] is buffer for key, buffer in buffers.items())
+    assert meter['loss_best'] == 0.5 and meter['loss_best_step'] == 4.0
+
+    with pytest.raises(ValueError):
+        AverageMeter('loss', best_modes={'loss': 'lowest'})
@@ -2,7 +2,7 @@
 import os
 import pytest
 
-from theconf.config import Config
+from theconf.config import Config, load_yamls, update_dict
 from theconf import ConfigArgumentParser
 
 
@@ -88,3 +88,44 @@ def test_arguments(datafiles):
     assert Config.get_instance()['foo']['baz'] == 3
     assert Config.get_instance()['foo']['qux'] == 4
     Config.clear()
+
+
+def test_parallel_load(tmpdir):
+    filenames = []
+    for i in range(16):
+        filename = str(tmpdir.join('fragment%02d.yaml' % i))
+        with open(filename, 'w') as f:
+            f.write('foo:\n    bar: %d\n    key%d: %d\nlast: %d\n' % (i, i, i, i))
+        filenames.append(filename)
+
+    sequential = {}
+    for data in load_yamls(filenames, max_workers=1):
+        update_dict(sequential, data)
+
+    config = Config(filenames, skip_timestamp=True, skip_git_info=True, max_workers=4)
+    assert config['foo']['bar'] == 15
+    assert config['last'] == 15
+    assert all(config['foo']['key%d' % i] == i for i in range(16))
+    assert {k: v for k, v in config.conf.items() if not k.startswith('_')} == sequential
+    assert list(config['foo'].keys()) == list(sequential['foo'].keys())
+    Config.clear()
+
+    assert load_yamls(filenames) == load_yamls(filenames, max_workers=1)
+    config = Config(filenames, skip_timestamp=True, skip_git_info=True)
+    assert {k: v for k, v in config.conf.items() if not k.startswith('_')} == sequential
+
+    Config.clear()
+
+
+@pytest.mark.filterwarnings("ignore:MarkInfo")
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'basic.yaml'),
+    os.path.join(FIXTURE_DIR, 'configs', 'basic2.yaml')
+)
+def test_lazy(datafiles):
+    filenames = [str(f) for f in datafiles.listdir(sort=True)]
+    config = Config(filenames, skip_timestamp=True, skip_git_info=True, lazy=True)
+
+    assert 'foo' in config._lazy
+    assert config['foo'] == {'bar': 1, 'baz': 3, 'qux': 4}
+    Config.clear()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+from theconf import Config
+from theconf import ConfigArgumentParser
+from theconf import schema as theconf_schema
+from theconf.schema import Schema, SchemaError
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'datas',
+)
+
+
+def test_schema_validate():
+    schema = Schema({'model': {'lr': float, 'depth': 'int', 'layers': [int], 'name': 'str?'},
+                     'train': {'amp': bool, 'tags': list}})
+    assert schema.spec['model']['layers'] == 'list[int]'
+    assert schema.fingerprint == Schema(schema.spec).fingerprint
+
+    tree = {'model': {'lr': '1e-3', 'depth': 18, 'layers': ['1', 2]}, 'train': {'amp': 'yes', 'tags': []},
+            '_version': 1}
+    assert schema.validate(tree) == [
+        (('model', 'lr'), 0.001), (('model', 'layers'), [1, 2]), (('train', 'amp'), True)]
+    assert tree['model']['lr'] == '1e-3'
+
+    # every error in one pass
+    with pytest.raises(SchemaError) as e:
+        schema.validate({'model': {'lr': 'fast', 'depht': 18, 'layers': 3, 'name': None}, 'train': {'amp': 1, 'tags': []}})
+    assert e.value.errors == [
+        ('model.lr', "expected float, got str 'fast'"),
+        ('model.depht', 'unknown key'),
+        ('model.layers', 'expected list, got int 3'),
+        ('model.depth', 'missing'),
+        ('train.amp', 'expected bool, got int 1'),
+    ]
+    assert isinstance(e.value, ValueError)
+    assert '5 config error(s)' in str(e.value)
+
+    with pytest.raises(ValueError):
+        Schema({'model': {'lr': 'double'}})
+
+
+def test_schema_infer():
+    schema = Schema.infer({'model': {'lr': 0.1, 'layers': [1, 2], 'name': None}, 'amp': False, '_version': 1})
+    assert schema.spec == {'model': {'lr': 'float', 'layers': 'list[int]', 'name': 'any'}, 'amp': 'bool'}
+    assert schema.validate({'model': {'lr': 1, 'layers': [], 'name': 'a'}, 'amp': 'false'}) == [
+        (('model', 'lr'), 1.0), (('amp',), False)]
+
+    relaxed = Schema.infer({'model': {'lr': 0.1}}, allow_extra=True)
+    assert relaxed.validate({'model': {'lr': 0.1, 'momentum': 0.9}}) == []
+
+
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'basic.yaml'),
+)
+def test_config_validate(datafiles, tmpdir):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+    config['foo']['bar'] = '3'
+
+    revision = config.revision
+    assert config.validate({'foo': {'bar': int, 'baz': int}}) == ['foo.bar']
+    assert config['foo']['bar'] == 3
+    assert config.at('foo.bar') == 3
+    assert config.changes(since=revision) == ['foo.bar']
+    with pytest.raises(SchemaError):
+        config.validate({'foo': {'bar': str}}, coerce=False)
+    Config.clear()
+
+    # a tree that passed once is not checked again, across launches with a cache directory
+    cache_dir = str(tmpdir.join('cache'))
+    tree = {'foo': {'bar': '1'}}
+    assert theconf_schema.validate(tree, {'foo': {'bar': int}}, cache_dir=cache_dir) == [(('foo', 'bar'), 1)]
+    assert len(os.listdir(cache_dir)) == 1
+    theconf_schema._VALIDATED.clear()
+
+    calls = []
+    schema = Schema({'foo': {'bar': int}})
+    validate = schema.validate
+    schema.validate = lambda *args, **kwargs: calls.append(args) or validate(*args, **kwargs)
+    assert theconf_schema.validate(tree, schema, cache_dir=cache_dir) == [(('foo', 'bar'), 1)]
+    assert theconf_schema.validate(tree, schema) == [(('foo', 'bar'), 1)]
+    assert calls == []
+    assert theconf_schema.validate({'foo': {'bar': 2}}, schema) == []
+    assert len(calls) == 1
+
+
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'arguments.yaml')
+)
+def test_arguments_schema(datafiles):
+    filenames = [str(f) for f in datafiles.listdir()]
+    parser = ConfigArgumentParser(filenames=filenames[0], schema={'foo': str, 'bar': int, 'var': bool})
+    parser.add_argument('--baz', type=str, default='0.5')
+    args = parser.parse_args(args=['-c', filenames[0], '--bar', '4321'])
+    assert args.bar == 4321
+    assert Config.get_instance()['baz'] == '0.5'
+    Config.clear()
+
+    parser = ConfigArgumentParser(filenames=filenames[0], schema={'foo': int, 'bar': int, 'var': bool, 'qux': int})
+    with pytest.raises(SystemExit):
+        parser.parse_args(args=['-c', filenames[0]])
+    Config.clear()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import pytest
+import yaml
+
+from theconf import Config
+from theconf import sweep
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'datas',
+)
+
+
+def _target(config):
+    if config['foo']['bar'] < 0:
+        raise ValueError('negative')
+    return config['foo']['bar'] * 10 + config['foo']['baz']
+
+
+def test_expand_grid():
+    runs = sweep.expand({'parameters': {'foo.bar': [1, 2, 1], 'foo.baz': {'values': [3, 4]}, 'foo.qux': 5}})
+    assert runs == [
+        {'foo.bar': 1, 'foo.baz': 3, 'foo.qux': 5},
+        {'foo.bar': 1, 'foo.baz': 4, 'foo.qux': 5},
+        {'foo.bar': 2, 'foo.baz': 3, 'foo.qux': 5},
+        {'foo.bar': 2, 'foo.baz': 4, 'foo.qux': 5},
+    ]
+    assert sweep.nest(runs[0]) == {'foo': {'bar': 1, 'baz': 3, 'qux': 5}}
+
+    with pytest.raises(ValueError):
+        sweep.expand({'parameters': {'foo.bar': {'min': 0.0, 'max': 1.0}}})
+    with pytest.raises(ValueError):
+        sweep.expand({'method': 'bayes', 'parameters': {}})
+
+
+def test_expand_random():
+    spec = {'method': 'random', 'count': 5, 'seed': 0, 'parameters': {
+        'foo.bar': {'min': 1, 'max': 100}, 'foo.baz': {'min': 1e-4, 'max': 1e-1, 'log': True}, 'foo.qux': [1, 2]}}
+    runs = sweep.expand(spec)
+    assert runs == sweep.expand(spec)
+    assert len(runs) == 5
+    assert all(isinstance(run['foo.bar'], int) and 1e-4 <= run['foo.baz'] <= 1e-1 for run in runs)
+
+    # a space smaller than count gives every distinct set once
+    assert len(sweep.expand({'method': 'random', 'count': 10, 'parameters': {'foo.bar': [1, 2]}})) == 2
+
+
+@pytest.mark.datafiles(
+    os.path.join(FIXTURE_DIR, 'configs', 'basic.yaml'),
+)
+def test_run(datafiles, tmpdir):
+    filenames = [str(f) for f in datafiles.listdir()]
+    config = Config(filenames[0], skip_timestamp=True, skip_git_info=True)
+
+    output_dir = str(tmpdir.join('sweep'))
+    summary = sweep.run(_target, {'parameters': {'foo.bar': [1, -1, 3]}}, output_dir=output_dir,
+                        max_workers=2, mp_context='fork')
+    assert [(entry['run'], entry['status'], entry['result']) for entry in summary] == [
+        (0, 'ok', 12), (1, 'failed', None), (2, 'ok', 32)]
+    assert 'negative' in summary[1]['error']
+
+    with open(os.path.join(output_dir, 'index.json')) as f:
+        assert json.load(f) == summary
+    with open(summary[2]['config']) as f:
+        dumped = yaml.safe_load(f)
+    assert dumped['foo'] == {'bar': 3, 'baz': 2}
+    assert dumped['_sweep'] == {'run': 2, 'overrides': {'foo.bar': 3}}
+
+    # the parent's config is untouched
+    assert config['foo']['bar'] == 1
+    assert '_sweep' not in config
+    Config.clear()
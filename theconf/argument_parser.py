@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import sys
 import logging
 import argparse
 
@@ -9,55 +10,63 @@ LOGGER = logging.getLogger(__name__)
 
 
 class ConfigArgumentParser(argparse.ArgumentParser):
-    def __init__(self, filenames=[], lazy=False, **kwargs):
+    def __init__(self, filenames=[], lazy=False, deferred=False, schema=None, interpolate=False, **kwargs):
         super(ConfigArgumentParser, self).__init__(add_help=False, **kwargs)
         self.add_argument('-c', '--config', nargs='+', required=(not filenames), help='set config filepath')
 
         filenames = filenames if isinstance(filenames, list) else [filenames]
         self.filenames = filenames
         self.lazy = lazy
+        self.deferred = deferred
+        self.schema = schema
+        self.interpolate = interpolate
         if not lazy:
             self._add_arguments_from_config(None if not self.filenames else ['-c'] + self.filenames)
 
     def _add_arguments_from_config(self, args, lazy=False):
         parsed, _ = self.parse_known_args(args=args)
-        Config(parsed.config)
+        Config(parsed.config, interpolate=self.interpolate)
 
         self.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='show this help message and exit')
-        for key, value in Config.get_instance().conf.items():
-            self._add_argument(key, value)
-
-    def _add_argument(self, key, value, prefix=None):
-        if key.startswith('_'):
+        self._config_dests = {}
+        if self.deferred:
+            # options are registered in parse_args only for keys present in argv, or all of them for --help
+            self._config_options = {'--' + '-'.join(keys): (keys, value) for keys, value in Config.get_instance().leaves()}
             return
-        key = key if prefix is None else prefix + '-' + key
+        for keys, value in Config.get_instance().leaves():
+            self._add_argument(keys, value)
+
+    def _add_deferred_arguments(self, args):
+        args = sys.argv[1:] if args is None else args
+        if '-h' in args or '--help' in args:
+            options = list(self._config_options.keys())
+        else:
+            options = [arg.split('=', 1)[0] for arg in args if arg.startswith('--')]
+        for option in options:
+            if option in self._config_options:
+                self._add_argument(*self._config_options.pop(option))
+            elif self.allow_abbrev and len(option) > 2:
+                # an abbreviation registers every key it could stand for, so argparse resolves it (or reports it as
+                # ambiguous) the same way it does with all the keys registered
+                for candidate in [candidate for candidate in self._config_options if candidate.startswith(option)]:
+                    self._add_argument(*self._config_options.pop(candidate))
+
+    def _add_argument(self, keys, value):
+        key = '-'.join(keys)
         if key in self._option_string_actions:
             LOGGER.error('%s already exist arguments', key)
-        elif isinstance(value, dict):
-            for k, v in value.items():
-                self._add_argument(k, v, key)
-        elif isinstance(value, list):
+            return
+        # help strings only render the default through %(default)s when help is actually printed
+        if isinstance(value, list):
             if value:
-                self.add_argument('--' + key, type=type(value[0]), nargs='*', default=value, help='set ' + type(value[0]).__name__ + ' list (default:' + str(value).replace('%', '%%') + ')')
+                action = self.add_argument('--' + key, type=type(value[0]), nargs='*', default=value, help='set ' + type(value[0]).__name__ + ' list (default:%(default)s)')
             else:
-                self.add_argument('--' + key, nargs='*', default=value, help='set list (default:' + str(value) + ')')
+                action = self.add_argument('--' + key, nargs='*', default=value, help='set list (default:%(default)s)')
         elif isinstance(value, bool):
-            self.add_argument('--' + key, type=str2bool, default=value, help='set ' + type(value).__name__ + ' value (default:' + str(value).replace('%', '%%') + ')')
+            action = self.add_argument('--' + key, type=str2bool, default=value, help='set bool value (default:%(default)s)')
         else:
-            self.add_argument('--' + key, type=type(value), default=value, help='set ' + type(value).__name__ + ' value (default:' + str(value).replace('%', '%%') + ')')
-
-    def _set_argument_from_conf(self, parsed_args, key, value, prefix=None):
-        key = key if prefix is None else '_'.join([prefix, key])
-        used = ['conf']
-        if isinstance(value, dict):
-            rv = {}
-            for k, v in value.items():
-                rv[k], local_used = self._set_argument_from_conf(parsed_args, k, v, key)
-                used += local_used
-        else:
-            used.append(key)
-            rv = getattr(parsed_args, key)
-        return rv, used
+            action = self.add_argument('--' + key, type=type(value), default=value, help='set ' + type(value).__name__ + ' value (default:%(default)s)')
+        self._config_dests[action.dest] = keys
 
     def _set_argument_from_args(self, keys, value, rv=None):
         rv = {} if rv is None else rv
@@ -70,23 +79,57 @@ class ConfigArgumentParser(argparse.ArgumentParser):
     def parse_args(self, args=None, namespace=None):
         if self.lazy:
             self._add_arguments_from_config(args)
+        if self.deferred:
+            self._add_deferred_arguments(args)
         parsed_args = super(ConfigArgumentParser, self).parse_args(args, namespace)
 
-        used = []
-        for key, value in Config.get_instance().conf.items():
-            if key.startswith('_'):
+        # config leaves are written in place through the config's path index; other arguments are nested by '_'
+        config = Config.get_instance()
+        changed, arguments = [], []
+        for dest, value in vars(parsed_args).items():
+            keys = self._config_dests.get(dest)
+            if dest == 'conf':
                 continue
-            Config.get_instance()[key], local_used = self._set_argument_from_conf(parsed_args, key, value)
-            used += local_used
-
-        for key, value in parsed_args.__dict__.items():
-            if key in used:
+            if keys is None:
+                keys = dest.split('_')
+                self._set_argument_from_args(keys, value, config._loaded())
+                changed.append('.'.join(keys))
+                arguments.append(keys)
                 continue
-            splited_keys = key.split('_')
-            Config.get_instance().conf = self._set_argument_from_args(splited_keys, value, Config.get_instance().conf)
-
+            parent, key, _ = config._locate(keys)
+            if parent[key] != value:
+                parent[key] = value
+                changed.append('.'.join(keys))
+
+        if changed:
+            revision = config.touch(*changed)
+            if config._interpolation is not None:
+                # values derived from an overridden key (${...}) were evaluated again
+                paths = {'.'.join(keys): dest for dest, keys in self._config_dests.items()}
+                for path in config.changes(since=revision - 1):
+                    if path in paths and hasattr(parsed_args, paths[path]):
+                        setattr(parsed_args, paths[path], config.at(path))
+        if self.schema is not None:
+            # the merged tree, files and overrides together, is checked once with every error reported
+            from .schema import SchemaError
+            try:
+                config.validate(self._schema_with_arguments(arguments))
+            except SchemaError as e:
+                self.error(str(e))
         return parsed_args
 
+    def _schema_with_arguments(self, arguments):
+        # arguments that are not config leaves (-c/--config, add_argument) are written into the tree too
+        from .schema import Schema, normalize
+        schema = self.schema
+        spec = normalize(schema.spec if isinstance(schema, Schema) else schema)
+        for keys in arguments:
+            parent = spec
+            for key in keys[:-1]:
+                parent = parent.setdefault(key, {})
+            parent.setdefault(keys[-1], 'any')
+        return Schema(spec, allow_extra=getattr(schema, 'allow_extra', False))
+
 
 def str2bool(v):
     if isinstance(v, bool):
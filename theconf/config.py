@@ -1,23 +1,48 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import os
+import copy
 import datetime
+import hashlib
+import json
 import logging
+import pickle
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
 from collections import namedtuple
+from collections.abc import Mapping
+from functools import partial
 import keyword
-import yaml
-import git
 
 
 LOGGER = logging.getLogger(__name__)
+_MISSING = object()
+TOP_LEVEL_LINE = re.compile(br'^(?:[^ #\r\n-]|-[^ \r\n]).*', re.M)
+TOP_LEVEL_KEY = re.compile(br'^([A-Za-z0-9_][^:#\s]*|\'[^\'\n]*\'|"[^"\n]*")[ ]*:(?:[ \r]|$)')
+LEADING_COMMENTS = re.compile(br'(?:[ ]*(?:#[^\n]*)?\r?\n)*')
+PLAIN_KEY = re.compile(r'^[A-Za-z_][A-Za-z0-9_\-]*$')
+ANCHOR_OR_ALIAS = re.compile(br'(?:^|[\s,\[{])[&*][^\s,\[\]{}]')
+QUOTED_START = re.compile(br'(?:^[ \t]*(?:-[ \t]+)*|:[ \t]+)(?:![^\s]*[ \t]+)?(["\'])', re.M)
+QUOTED_REST = {b'"': re.compile(br'(?:[^"\\\r\n]|\\[^\r\n])*"'), b"'": re.compile(br"(?:[^'\r\n]|'')*'(?!')")}
+_PROCESS_LOCAL = ('_write_lock', '_published', '_git_future', '_dump_executor', '_watcher', '_reload_lock', '_shared',
+                  '_shared_owner')
+YAML_RESERVED = ('y', 'n', 'yes', 'no', 'on', 'off', 'true', 'false', 'null')
 
 
 class Config():
     _instance = None
+    _instance_lock = threading.Lock()
 
     @staticmethod
     def get_instance():
         if Config._instance is None:
-            Config()
+            with Config._instance_lock:
+                if Config._instance is None:
+                    Config()
         return Config._instance
 
     @staticmethod
@@ -28,109 +53,999 @@ class Config():
     def clear():
         Config._instance = None
 
-    def update_git_info(self):
-        try:
-            repo = git.Repo('./')
-            remotes = [u for u in repo.remotes.origin.urls]
-            if remotes:
-                remote = remotes[0]
-                branch = repo.active_branch.name
-                commit = next(repo.iter_commits())
-                hash_ = commit.hexsha
-                comment = commit.message
-
-                self.conf['_git'] = {
-                    'remote': remote,
-                    'branch': branch,
-                    'commit': {
-                        'hash': hash_,
-                        'comment': comment
-                    },
-                    'status': {
-                        'diff': [
-                            {'type': diff.change_type, 'path': diff.b_path}
-                            for diff in repo.index.diff(None)
-                        ],
-                        'untracked': repo.untracked_files
-                    }
-                }
-        except Exception as e:
-            LOGGER.debug('[update_git_info] %s:%s', type(e), str(e))
+    @staticmethod
+    def attach(name):
+        # builds the singleton from a snapshot published by Config.share; subtrees are unpickled on first access
+        if Config._instance is not None:
+            raise Exception('This class is a singleton!')
+        from multiprocessing import shared_memory
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = _attach_untracked(shared_memory, name)
+        header_size, = struct.unpack_from('<Q', shm.buf, 0)
+        filenames, index, templates = pickle.loads(shm.buf[8:8 + header_size])
+        base = 8 + header_size
+
+        config = Config()
+        config._conf.clear()
+        config.filenames = filenames
+        config._lazy = {key: [partial(load_shared_chunk, shm, base + start, base + end, key)] for key, start, end in index}
+        config._lazy_keys = list(config._lazy.keys())
+        config._shared = shm
+        if templates:
+            # values arrive evaluated; the graph is kept so overrides still update what depends on them
+            config._interpolation_graph().restore(templates)
+        return config
+
+    def share(self, name=None):
+        # freezes the current tree into shared memory; children call Config.attach(name) instead of re-parsing
+        chunks, index, offset = [], [], 0
+        for key, value in self._loaded().items():
+            chunk = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            index.append((key, offset, offset + len(chunk)))
+            chunks.append(chunk)
+            offset += len(chunk)
+        templates = self._interpolation.templates() if self._interpolation is not None else {}
+        header = pickle.dumps((self.__dict__.get('filenames', []), index, templates), protocol=pickle.HIGHEST_PROTOCOL)
+        base = 8 + len(header)
+
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=name, create=True, size=base + offset)
+        struct.pack_into('<Q', shm.buf, 0, len(header))
+        shm.buf[8:base] = header
+        for (_, start, end), chunk in zip(index, chunks):
+            shm.buf[base + start:base + end] = chunk
+        self.unshare()
+        self._shared_owner = shm
+        return shm.name
+
+    def unshare(self):
+        shm = self.__dict__.pop('_shared_owner', None)
+        if shm is not None:
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                LOGGER.warning('[unshare] %s was already unlinked', shm.name)
+
+    def __getstate__(self):
+        # children get the tree (spawn workers, Process(args=(C.get(),))); locks, threads, executors and shared
+        # memory stay with this process
+        self._collect_git_info(wait=True)
+        if '_shared' in self.__dict__:
+            self._loaded()
+        # the namedtuple view is built from classes made at runtime, which pickle cannot find by name
+        dropped = set(_PROCESS_LOCAL + ('_view', '_view_keys', '_view_cache')) | set(self.__dict__.get('_view_keys', ()))
+        state = {key: value for key, value in self.__dict__.items() if key not in dropped}
+        if self._interpolation is not None:
+            state['_interpolation'] = None
+            state['_interpolation_templates'] = self._interpolation.templates()
+        return state
+
+    def __setstate__(self, state):
+        templates = state.pop('_interpolation_templates', None)
+        self.__dict__.update(state)
+        self._write_lock = threading.RLock()
+        self._published = None
+        self._git_future = None
+        self._dump_executor = None
+        self._view_cache = (0, None)
+        self._invalidate_view()
+        if templates:
+            self._interpolation_graph().restore(templates)
+
+    def update_git_info(self, fast=False, background=False):
+        # background collection is installed on the next access to _git or at dump()
+        read = read_git_info_fast if fast else read_git_info
+        if background:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=1)
+            # resolved now, a script may chdir before the worker runs
+            self._git_future = executor.submit(read, os.path.abspath('./'))
+            executor.shutdown(wait=False)
+        else:
+            self._git_future = None
+            self._set_git_info(read('./'))
         return self
 
-    def dump(self, filename=None):
-        self.conf['_version'] += 1
-        dump_string = yaml.dump(self.conf, default_flow_style=False)
+    def _set_git_info(self, git_info):
+        if git_info is not None:
+            self._lazy.pop('_git', None)
+            self._conf['_git'] = git_info
+
+    def _collect_git_info(self, wait=False):
+        future = self.__dict__.get('_git_future')
+        if future is None or not (wait or future.done()):
+            return
+        self._git_future = None
+        self._set_git_info(future.result())
+
+    def dump(self, filename=None, format='yaml', background=False):
+        self._collect_git_info(wait=True)
+        self._loaded()['_version'] += 1
+        self.touch('_version')
+        # pickling is the snapshot: it is cheap, and serialization can then run off the calling thread
+        snapshot = [(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)) for key, value in self._loaded().items()]
+        if not background:
+            return self._dump_snapshot(snapshot, filename, format)
+        if self._dump_executor is None:
+            # a single worker keeps background dumps to the same file in call order
+            from concurrent.futures import ThreadPoolExecutor
+            self._dump_executor = ThreadPoolExecutor(max_workers=1)
+        return self._dump_executor.submit(self._dump_snapshot, snapshot, filename, format)
+
+    def _dump_snapshot(self, snapshot, filename, format):
+        if format == 'yaml':
+            try:
+                snapshot = sorted(snapshot, key=lambda item: item[0])
+            except TypeError:
+                pass
+            fragments = []
+            for key, fingerprint in snapshot:
+                cached = self._dump_cache.get(key)
+                if cached is None or cached[0] != fingerprint:
+                    fragment = yaml_dump({key: pickle.loads(fingerprint)})
+                    cached = self._dump_cache[key] = (fingerprint, fragment)
+                fragments.append(cached[1])
+            dump_string = ''.join(fragments)
+        elif format == 'json':
+            tree = {key: pickle.loads(fingerprint) for key, fingerprint in snapshot}
+            dump_string = json.dumps(tree, indent=2, sort_keys=True, default=str) + '\n'
+        elif format == 'msgpack':
+            import msgpack
+            tree = {key: pickle.loads(fingerprint) for key, fingerprint in snapshot}
+            dump_string = msgpack.packb(tree, default=str)
+        else:
+            raise ValueError('unknown dump format: %s' % format)
+
         if filename is not None:
-            with open(filename, 'w') as f:
-                f.write(dump_string)
+            write_atomic(filename, dump_string)
         return dump_string
 
-    def __init__(self, filenames=[], skip_timestamp=True, skip_git_info=True):
+    def __init__(self, filenames=[], skip_timestamp=True, skip_git_info=True, cache_dir=None, max_workers=None, lazy=False,
+                 git_mode='background', interpolate=False):
         if Config._instance is not None:
             raise Exception('This class is a singleton!')
 
+        self._revision = 0
+        self._changes = {}
+        self._view_cache = (0, None)
+        self._dump_cache = {}
+        self._dump_executor = None
+        self._subscribers = []
+        self._write_lock = threading.RLock()
+        self._published = None
+        self._flat = {}
+        self._interpolation = None
+        self._interpolate_templates = interpolate
+        self._handouts = {}
+        self._handed_root = None
         self.conf = {}
         if filenames:
             filenames = filenames if isinstance(filenames, list) else [filenames]
             LOGGER.info('load config at: %s', ','.join(filenames))
             self.filenames = filenames
+            # what reload() compares against: the files as they were when loaded
+            signatures = [_file_signature(filename) for filename in filenames]
 
-            for filename in filenames:
-                with open(filename, 'r') as f:
-                    # self.conf = yaml.safe_load(f)
-                    update_dict(self.conf, yaml.safe_load(f))
+            indexes = [index_yaml(filename) for filename in filenames] if lazy else []
+            if indexes and all(index is not None for index in indexes):
+                # top-level subtrees stay in the files and are parsed on first access
+                for filename, index in zip(filenames, indexes):
+                    for key, offsets in index.items():
+                        self._lazy.setdefault(key, []).append(partial(load_yaml_chunk, filename, *offsets, key=key))
+                self._lazy_keys = list(self._lazy.keys())
+                self._reload_state = (signatures, None)
+            else:
+                cache_dir = cache_dir if cache_dir is not None else os.environ.get('THECONF_CACHE_DIR')
+                trees = load_yamls(filenames, cache_dir=cache_dir, max_workers=max_workers)
+                # copies, since merging shares subtrees between the parsed files and the tree
+                self._reload_state = (signatures, [pickle.loads(pickle.dumps(tree, protocol=pickle.HIGHEST_PROTOCOL))
+                                                   for tree in trees])
+                for data in trees:
+                    update_dict(self._loaded(), data)
+                self._interpolate(list(self._conf.keys()))
 
-        if '_version' not in self.conf:
-            self.conf['_version'] = 1
+        if '_version' not in self:
+            self._conf['_version'] = 1
         if not skip_timestamp:
-            self.conf['_timestamp'] = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+            self._lazy.pop('_timestamp', None)
+            self._conf['_timestamp'] = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
         if not skip_git_info:
-            self.update_git_info()
+            self.update_git_info(fast=(git_mode == 'fast'), background=(git_mode == 'background'))
 
         Config._instance = self
         self.get = self._instance_get
 
+    @property
+    def conf(self):
+        # the whole tree is handed out: while it is held, every key may change in place and nothing is pinned
+        conf = self._loaded()
+        self._invalidate_view()
+        self._handed_root = conf
+        return conf
+
+    def _loaded(self):
+        self._collect_git_info()
+        if self._lazy:
+            self._materialize()
+        return self._conf
+
+    @conf.setter
+    def conf(self, value):
+        previous = set(self.__dict__.get('_conf', {}).keys()) | set(self.__dict__.get('_lazy', {}).keys())
+        self._conf = value
+        self._lazy = {}
+        self._lazy_keys = []
+        self._view_cache = (0, None)
+        self.touch(*previous | set(value.keys()))
+
+    def _materialize(self, key=None):
+        for key in [key] if key is not None else list(self._lazy.keys()):
+            if key not in self._lazy:
+                # already materialized by a reference from a subtree before it
+                continue
+            tree = {}
+            for load in self._lazy.pop(key):
+                update_dict(tree, load())
+            self._conf[key] = tree[key]
+            self._interpolate([key])
+
+        if not self._lazy:
+            # restore the key order a full parse would have produced
+            ordered = {key: self._conf.pop(key) for key in self._lazy_keys if key in self._conf}
+            ordered.update(self._conf)
+            self._conf.clear()
+            self._conf.update(ordered)
+            self._lazy_keys = []
+
+    @property
+    def revision(self):
+        return self._revision
+
+    def touch(self, *paths):
+        # records dotted paths written since the last revision; call it after mutating nested dicts in place
+        with self._write_lock:
+            for path in paths:
+                self._flat.pop(path.split('.', 1)[0], None)
+            # templates written with the paths are registered, and the values depending on them evaluated again
+            evaluated = self._interpolate(paths) if paths else []
+            paths = paths + tuple(evaluated)
+            self._revision += 1
+            for path in paths:
+                self._changes[path] = self._revision
+                self._flat.pop(path.split('.', 1)[0], None)
+            self._invalidate_view()
+            if self._published is not None:
+                self._publish(paths)
+            return self._revision
+
+    def snapshot(self):
+        """Immutable copy of the tree at the latest revision, safe to read from any thread without locks.
+
+        The first call builds it; after that every write through Config (touch, update, __setitem__,
+        ConfigArgumentParser) publishes a new snapshot that shares the unchanged top-level subtrees.
+        """
+        published = self._published
+        if published is None:
+            with self._write_lock:
+                if self._published is None:
+                    self._publish(None)
+                published = self._published
+        return published
+
+    def _publish(self, paths):
+        previous = self._published
+        changed = None if previous is None or paths is None else set(path.split('.', 1)[0] for path in paths)
+        data = {}
+        for key, value in self._loaded().items():
+            if changed is not None and key not in changed and key in previous:
+                data[key] = previous[key]
+            else:
+                data[key] = freeze(value)
+        # a single reference assignment, readers see either the previous or the new snapshot
+        self._published = Snapshot(self._revision, data)
+
+    def changes(self, since=0):
+        return sorted(path for path, revision in self._changes.items() if revision > since)
+
+    def update(self, values):
+        with self._write_lock:
+            update_dict(self._loaded(), values)
+            return self.touch(*['.'.join(keys) for keys in _leaf_keys([], values)])
+
+    def validate(self, schema, coerce=True, cache_dir=None):
+        """Checks the merged tree against a schema (see theconf.schema) and writes coerced values back.
+
+        Raises SchemaError listing every error; returns the dotted paths that were coerced.
+        """
+        from .schema import validate  # imported only when used
+        with self._write_lock:
+            coercions = validate(self._loaded(), schema, coerce=coerce, cache_dir=cache_dir)
+            for keys, value in coercions:
+                parent = self._conf
+                for key in keys[:-1]:
+                    parent = parent[key]
+                parent[keys[-1]] = value
+            paths = ['.'.join(str(key) for key in keys) for keys, _ in coercions]
+            if paths:
+                self.touch(*paths)
+            return paths
+
+    def resolve(self, text):
+        # evaluates a template against the current tree, e.g. config.resolve('${run.dir}/${run.name}.log')
+        if self._interpolation is not None:
+            return self._interpolation.evaluate(text)
+        from .interpolation import compile_template  # imported only when used
+        return compile_template(text)[0](self._lookup)
+
+    def _interpolate(self, paths):
+        interpolation = self._interpolation
+        if interpolation is None:
+            if not self._interpolate_templates:
+                return []
+            # the graph is only built once a template shows up
+            if not any(_has_template(_walk(self._tree(path.split('.', 1)[0]), path)) for path in paths):
+                return []
+            interpolation = self._interpolation_graph()
+        return interpolation.changed(paths)
+
+    def _interpolation_graph(self):
+        if self._interpolation is None:
+            from .interpolation import Interpolation  # imported only when used
+            self._interpolation = Interpolation(self._tree, self._lookup)
+        return self._interpolation
+
+    def _tree(self, top):
+        if top in self._lazy:
+            self._materialize(top)
+        return self._conf
+
+    def _lookup(self, path):
+        try:
+            return self.at(path)
+        except KeyError:
+            pass
+        # list items, and subtrees a template has just replaced
+        found = _walk(self._conf, path)
+        if found is None:
+            raise KeyError(path)
+        return found[1]
+
+    def subscribe(self, callback, prefix=''):
+        # callback(path, old_value, new_value) for every dotted path under prefix that a reload changes
+        self._subscribers.append((callback, prefix))
+        return callback
+
+    def unsubscribe(self, callback):
+        self._subscribers = [(c, prefix) for c, prefix in self._subscribers if c is not callback]
+
+    def watch(self, interval=1.0, debounce=0.5):
+        # opt-in hot reload: a daemon thread polls the files and reloads once they stop changing for debounce seconds
+        self.unwatch()
+        self._prepare_reload()
+        stop = threading.Event()
+
+        def poll():
+            pending, since = None, 0.0
+            while not stop.wait(interval):
+                signatures = [_file_signature(filename) for filename in self.__dict__.get('filenames', [])]
+                if signatures == self._reload_state[0]:
+                    pending = None
+                elif signatures != pending:
+                    pending, since = signatures, time.monotonic()
+                elif time.monotonic() - since >= debounce:
+                    try:
+                        self.reload()
+                    except Exception as e:
+                        LOGGER.warning('[watch] reload failed %s:%s', type(e), str(e))
+                    pending = None
+
+        self._watcher = (threading.Thread(target=poll, name='ConfigWatcher', daemon=True), stop)
+        self._watcher[0].start()
+        return self
+
+    def unwatch(self):
+        watcher = self.__dict__.pop('_watcher', None)
+        if watcher is not None:
+            watcher[1].set()
+            watcher[0].join()
+
+    def _prepare_reload(self):
+        if '_reload_lock' not in self.__dict__:
+            self._reload_lock = threading.Lock()
+        state = self.__dict__.get('_reload_state')
+        if state is not None and state[1] is not None:
+            return
+        # lazy loads (and attached configs) have no parsed files yet; a file that changed since the load has
+        # no known previous tree, so all of it is applied by the next reload
+        filenames = self.__dict__.get('filenames', [])
+        current = [_file_signature(filename) for filename in filenames]
+        signatures = state[0] if state is not None else current
+        trees = [load_yaml(filename) if signature == now else {}
+                 for filename, signature, now in zip(filenames, signatures, current)]
+        self._reload_state = (signatures, trees)
+
+    def reload(self):
+        """Re-parses the files that changed since the last load and applies what changed in them.
+
+        Values set at runtime stay unless the files changed them, and keys removed from a file stay as they are,
+        like update_dict. The new tree is built aside and swapped in with one assignment, so readers see either
+        the previous or the next tree. Returns {dotted path: (old, new)} for the values that actually changed.
+        """
+        self._prepare_reload()
+        with self._reload_lock:
+            previous_signatures, previous_trees = self._reload_state
+            filenames = self.__dict__.get('filenames', [])
+            signatures = [_file_signature(filename) for filename in filenames]
+            trees = list(previous_trees)
+            for i, filename in enumerate(filenames):
+                if signatures[i] != previous_signatures[i]:
+                    try:
+                        trees[i] = load_yaml(filename)
+                    except Exception as e:
+                        # keep the last good tree until the file changes again
+                        LOGGER.warning('[reload] failed to load %s %s:%s', filename, type(e), str(e))
+            self._reload_state = (signatures, trees)
+
+            conf, merged = copy.deepcopy(self._loaded()), merge_dicts(trees)
+            for keys in diff_dict(merge_dicts(previous_trees), merged):
+                value = merged
+                for key in keys:
+                    value = value.get(key, _MISSING) if isinstance(value, dict) else _MISSING
+                if value is _MISSING:
+                    continue
+                parent = conf
+                for key in keys[:-1]:
+                    if not isinstance(parent.get(key), dict):
+                        parent[key] = {}
+                    parent = parent[key]
+                parent[keys[-1]] = value
+            changed = {'.'.join(keys): values for keys, values in diff_dict(self._loaded(), conf).items()}
+            if not changed:
+                return {}
+            self._conf = conf
+            self.touch(*changed)
+
+        for callback, prefix in list(self._subscribers):
+            for path, (old, new) in changed.items():
+                if path == prefix or path.startswith(prefix + '.') or not prefix:
+                    try:
+                        callback(path, old, new)
+                    except Exception as e:
+                        LOGGER.warning('[reload] subscriber failed at %s %s:%s', path, type(e), str(e))
+        return changed
+
+    def _invalidate_view(self):
+        for key in self.__dict__.pop('_view_keys', ()):
+            self.__dict__.pop(key, None)
+        self._view = None
+        self._view_keys = set()
+
+    def _release(self, key):
+        # a subtree handed out as a dict may be written in place at any time later: while it is still in the tree
+        # it is not pinned and its view is rebuilt on every attribute read
+        value = self._conf.get(key)
+        if type(value) is dict:
+            self._handouts[key] = value
+            self._view = None
+            if key in self._view_keys:
+                self._view_keys.discard(key)
+                self.__dict__.pop(key, None)
+
+    def _handed_out(self):
+        # top-level keys that may have been written in place since the last view: subtrees handed out as dicts
+        # and still in the tree, or every key while the whole tree is held outside
+        conf = self._conf
+        if self._handed_root is conf:
+            return set(conf.keys())
+        handouts = self._handouts
+        for key in [key for key, value in handouts.items() if conf.get(key, _MISSING) is not value]:
+            del handouts[key]
+        return set(handouts.keys())
+
+    def _build_view(self):
+        # the revision is read before the tree, so a tree swapped in meanwhile is rebuilt on the next access
+        current = self._revision
+        conf = self._loaded()
+        revision, previous = self._view_cache
+        if previous is None:
+            view = dict_to_namedtuple('conf', conf)
+        else:
+            # only top-level subtrees written since the previous view, or handed out, are rebuilt
+            changed = set(path.split('.', 1)[0] for path in self.changes(revision)) | self._handed_out()
+            keys = _namedtuple_keys(conf)
+            view = namedtuple('conf', keys)(*(
+                getattr(previous, k) if k not in changed and k in previous._fields else
+                dict_to_namedtuple('conf_' + k, conf[k]) if isinstance(conf[k], dict) else conf[k]
+                for k in keys
+            ))
+        self._view_cache = (current, view)
+        return view
+
     def _instance_get(self, key, default_value=''):
-        return self.conf.get(key, default_value)
+        if key == '_git':
+            self._collect_git_info(wait=True)
+        if key in self._lazy:
+            self._materialize(key)
+        value = self._conf.get(key, default_value)
+        if type(value) is dict:
+            self._release(key)
+        return value
 
-    def _flatten(self, keys, values):
-        flatten_list = []
+    def _flatten(self, keys, values, flatten_list=None):
+        # appends to one list instead of concatenating per level
+        flatten_list = [] if flatten_list is None else flatten_list
         if isinstance(values, dict):
             for key, value in values.items():
                 if key.startswith('_'):
                     continue
-                v = self._flatten(keys + [key], value)
-                flatten_list += v
+                self._flatten(keys + [key], value, flatten_list)
         elif isinstance(values, list):
             for key, value in enumerate(values):
-                v = self._flatten(keys + [str(key)], value)
-                flatten_list += v
+                self._flatten(keys + [str(key)], value, flatten_list)
         else:
-            v = [('-'.join(keys), values)]
-            flatten_list += v
+            flatten_list.append(('-'.join(keys), values))
         return flatten_list
 
     def flatten(self, key=None):
         if key is not None:
-            return dict(self._flatten([], self.conf[key]))
-        return dict(self._flatten([], self.conf))
+            return dict(self._flatten([], self._loaded()[key]))
+        return dict(self._flatten([], self._loaded()))
+
+    def _flat_index(self, top):
+        # per top-level key: dotted path -> (parent, key, keys, private, dashed) for every node of the subtree in
+        # definition order, plus dashed aliases; rebuilt when the subtree is touched or replaced
+        subtree = self._tree(top)[top]
+        cached = self._flat.get(top)
+        if cached is not None and cached[0] is subtree:
+            return cached
+        entries = {str(top): (self._conf, top, (top,), str(top).startswith('_'), str(top))}
+        aliases = {}
+        stack = [((top,), str(top), str(top), entries[str(top)][3], iter(subtree.items()))] if isinstance(subtree, dict) else []
+        while stack:
+            prefix, dotted_prefix, dashed_prefix, hidden, items = stack[-1]
+            node = entries[dotted_prefix][0][prefix[-1]]
+            for key, value in items:
+                path, name = prefix + (key,), str(key)
+                dotted, dashed = dotted_prefix + '.' + name, dashed_prefix + '-' + name
+                private = hidden or name.startswith('_')
+                entries[dotted] = (node, key, path, private, dashed)
+                aliases[dashed] = dotted
+                if isinstance(value, dict):
+                    stack.append((path, dotted, dashed, private, iter(value.items())))
+                    break
+            else:
+                stack.pop()
+        cached = self._flat[top] = (subtree, entries, aliases)
+        return cached
+
+    def locate(self, path):
+        """(parent dict, key) of a dotted path ('a.b.c'), a dashed path ('a-b-c') or a sequence of keys."""
+        parent, key, top = self._locate(path)
+        self._release(top)
+        return parent, key
+
+    def _locate(self, path):
+        # locate() without handing the subtree out, for writes that touch() what they change
+        if isinstance(path, str):
+            top = path.partition('.')[0]
+            cached = self._flat.get(top)
+            entry = cached[1].get(path) if cached is not None else None
+            if entry is not None and self._attached(entry):
+                return entry[0], entry[1], top
+            candidates = [top] + ['-'.join(path.split('-')[:i + 1]) for i in range(path.count('-'))]
+        else:
+            path = '.'.join(str(key) for key in path)
+            candidates = [path.split('.', 1)[0]]
+        for top in candidates:
+            if top in self:
+                _, entries, aliases = self._flat_index(top)
+                entry = entries.get(path) or entries.get(aliases.get(path))
+                if entry is None or not self._attached(entry):
+                    # the subtree may have grown or been replaced in place without touch(): index it again once
+                    del self._flat[top]
+                    _, entries, aliases = self._flat_index(top)
+                    entry = entries.get(path) or entries.get(aliases.get(path))
+                if entry is not None:
+                    return entry[0], entry[1], top
+        raise KeyError(path)
+
+    def _attached(self, entry):
+        # the parent dicts an entry was indexed with are still the ones in the tree: one lookup per level
+        node = self._conf
+        for key in entry[2][:-1]:
+            node = node.get(key, _MISSING) if type(node) is dict else _MISSING
+        return node is entry[0]
+
+    def at(self, path, default=_MISSING):
+        # a dict lookup once the subtree is indexed, checked against the live parents of the path
+        if isinstance(path, str):
+            top = path.partition('.')[0]
+            cached = self._flat.get(top)
+            entry = cached[1].get(path) if cached is not None else None
+            if entry is not None and self._attached(entry):
+                value = entry[0][entry[1]]
+                if type(value) is dict:
+                    self._release(top)
+                return value
+        try:
+            parent, key, top = self._locate(path)
+        except KeyError:
+            if default is _MISSING:
+                raise
+            return default
+        value = parent[key]
+        if type(value) is dict:
+            self._release(top)
+        return value
+
+    def leaves(self, prefix='', private=False):
+        """(keys, value) for every non-dict value under a dotted prefix in definition order.
+
+        Keys starting with '_' are skipped unless private is set. Walks the live tree, so nested dicts written
+        without touch() are seen too.
+        """
+        if prefix:
+            top = prefix.split('.', 1)[0]
+            found = _walk({top: self._tree(top)[top]}, prefix) if top in self else None
+            if found is None:
+                return
+            keys, value = found
+            if not private and any(str(key).startswith('_') for key in keys):
+                return
+            if not isinstance(value, dict):
+                yield keys, value
+                return
+            stack = [(keys, iter(value.items()))]
+        else:
+            stack = [((), iter(self._loaded().items()))]
+        while stack:
+            keys, items = stack[-1]
+            for key, value in items:
+                if not private and str(key).startswith('_'):
+                    continue
+                if isinstance(value, dict):
+                    stack.append((keys + (key,), iter(value.items())))
+                    break
+                yield keys + (key,), value
+            else:
+                stack.pop()
 
     def __str__(self):
-        return 'filenames:%s\nconf:%s' % (','.join(self.filenames), self.conf)
+        return 'filenames:%s\nconf:%s' % (','.join(self.filenames), self._loaded())
 
     def __contains__(self, item):
-        return item in self.conf
+        if item == '_git':
+            self._collect_git_info(wait=True)
+        return item in self._conf or item in self._lazy
 
     def __getitem__(self, key, default_value=''):
-        return self.conf[key]
+        if key == '_git':
+            self._collect_git_info(wait=True)
+        if key in self._lazy:
+            self._materialize(key)
+        value = self._conf[key]
+        if type(value) is dict:
+            self._release(key)
+        return value
 
     def __setitem__(self, key, value):
-        self.conf[key] = value
+        with self._write_lock:
+            self._lazy.pop(key, None)
+            self._conf[key] = value
+            self.touch(key)
 
     def __getattr__(self, key):
-        tuples = dict_to_namedtuple('conf', self.conf)
-        return getattr(tuples, key)
+        # only reached for names missing on the instance: the namedtuple view is built once and resolved names are
+        # pinned on the instance until the tree changes through Config or the subtree is handed out as a dict
+        if '_conf' not in self.__dict__ or key.startswith('__'):
+            raise AttributeError(key)
+        revision, view = self._revision, None
+        if self._lazy:
+            # resolve a single subtree without materializing the whole tree
+            if key.startswith('_') or keyword.iskeyword(key) or key not in self:
+                raise AttributeError(key)
+            if key in self._lazy:
+                self._materialize(key)
+            value = self._conf[key]
+            value = dict_to_namedtuple('conf_' + key, value) if isinstance(value, dict) else value
+        else:
+            view = self._view if self._view is not None else self._build_view()
+            value = getattr(view, key)
+        if self._revision == revision:
+            # not cached when a write landed meanwhile, it may be from the previous tree
+            handed_out = self._handed_out()
+            if view is not None and not handed_out:
+                self._view = view
+            if key not in handed_out:
+                self._view_keys.add(key)
+                self.__dict__[key] = value
+        return value
+
+
+class FrozenDict(Mapping):
+    # read-only mapping with attribute access, the building block of Config.snapshot();
+    # keys are also stored as instance attributes so attribute reads skip __getattr__
+    def __init__(self, data):
+        self.__dict__.update((key, value) for key, value in data.items()
+                             if isinstance(key, str) and not hasattr(type(self), key))
+        self.__dict__['_data'] = data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getattr__(self, key):
+        try:
+            return self._data[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        raise TypeError('%s is read-only' % type(self).__name__)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self._data)
+
+
+class Snapshot(FrozenDict):
+    revision = 0
+
+    def __init__(self, revision, data):
+        super(Snapshot, self).__init__(data)
+        self.__dict__['revision'] = revision
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def yaml_load(content):
+    # yaml and git are imported on first use so that `import theconf` stays cheap
+    import yaml
+    return yaml.load(content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def yaml_dump(data):
+    # libyaml folds long non-ASCII strings at other places than yaml.Dumper: the same values, not the same bytes
+    import yaml
+    return yaml.dump(data, Dumper=getattr(yaml, 'CDumper', yaml.Dumper), default_flow_style=False)
+
+
+def load_yaml(filename, cache_dir=None):
+    with open(filename, 'rb') as f:
+        content = f.read()
+    if not cache_dir:
+        return yaml_load(content)
+
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    key = (path, stat.st_mtime_ns, stat.st_size, hashlib.sha1(content).hexdigest())
+    cache_path = os.path.join(cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.pickle')
+    try:
+        with open(cache_path, 'rb') as f:
+            if pickle.load(f) == key:
+                return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError) as e:
+        LOGGER.debug('[load_yaml] %s:%s', type(e), str(e))
+
+    data = yaml_load(content)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_atomic(cache_path, pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL) +
+                     pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+    except (IOError, OSError) as e:
+        LOGGER.warning('[load_yaml] failed to write cache %s: %s', cache_path, str(e))
+    return data
+
+
+def read_git_info(path):
+    try:
+        import git
+        repo = git.Repo(path)
+        remotes = [u for u in repo.remotes.origin.urls]
+        if remotes:
+            commit = next(repo.iter_commits())
+            return {
+                'remote': remotes[0],
+                'branch': repo.active_branch.name,
+                'commit': {
+                    'hash': commit.hexsha,
+                    'comment': commit.message
+                },
+                'status': {
+                    'diff': [
+                        {'type': diff.change_type, 'path': diff.b_path}
+                        for diff in repo.index.diff(None)
+                    ],
+                    'untracked': repo.untracked_files
+                }
+            }
+    except Exception as e:
+        LOGGER.debug('[read_git_info] %s:%s', type(e), str(e))
+    return None
+
+
+def read_git_info_fast(path):
+    # reads HEAD, refs and the origin url straight from .git without spawning git; no working tree status
+    try:
+        git_dir = os.path.join(path, '.git')
+        if os.path.isfile(git_dir):
+            with open(git_dir, 'r') as f:
+                git_dir = os.path.join(path, f.read().strip()[len('gitdir:'):].strip())
+        common_dir = git_dir
+        if os.path.isfile(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir'), 'r') as f:
+                common_dir = os.path.join(git_dir, f.read().strip())
+
+        remote = _read_git_remote(os.path.join(common_dir, 'config'), 'origin')
+        if remote is None:
+            return None
+
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+        if head.startswith('ref:'):
+            ref = head[len('ref:'):].strip()
+            branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+            hash_ = _read_git_ref(git_dir, common_dir, ref)
+        else:
+            branch, hash_ = None, head
+
+        return {
+            'remote': remote,
+            'branch': branch,
+            'commit': {
+                'hash': hash_,
+                'comment': _read_git_commit_message(common_dir, hash_) if hash_ else None
+            }
+        }
+    except Exception as e:
+        LOGGER.debug('[read_git_info_fast] %s:%s', type(e), str(e))
+    return None
+
+
+def _read_git_remote(filename, name):
+    section = None
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('['):
+                section = line
+            elif section == '[remote "%s"]' % name and line.split('=', 1)[0].strip() == 'url':
+                return line.split('=', 1)[1].strip()
+    return None
+
+
+def _read_git_ref(git_dir, common_dir, ref):
+    for directory in (git_dir, common_dir):
+        if os.path.isfile(os.path.join(directory, ref)):
+            with open(os.path.join(directory, ref), 'r') as f:
+                return f.read().strip()
+    if os.path.isfile(os.path.join(common_dir, 'packed-refs')):
+        with open(os.path.join(common_dir, 'packed-refs'), 'r') as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split(' ', 1)[0]
+    return None
+
+
+def _read_git_commit_message(common_dir, hash_):
+    # only loose objects are read; commits that live in a pack file report no message
+    filename = os.path.join(common_dir, 'objects', hash_[:2], hash_[2:])
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as f:
+        content = zlib.decompress(f.read())
+    content = content.split(b'\x00', 1)[1]
+    return content.split(b'\n\n', 1)[1].decode('utf-8', 'replace') if b'\n\n' in content else ''
+
+
+def index_yaml(filename):
+    # byte ranges of each top-level key of a plain block mapping; None if the file needs a full parse
+    with open(filename, 'rb') as f:
+        content = f.read()
+    if (b'&' in content or b'*' in content) and ANCHOR_OR_ALIAS.search(content):
+        return None
+    if (b'"' in content or b"'" in content) and _unclosed_quote(content):
+        # a quoted scalar may go on at column 0, where it would look like the next key
+        return None
+
+    lines = [(match.start(), match.group(0)) for match in TOP_LEVEL_LINE.finditer(content)]
+    if not lines or lines[0][0] != LEADING_COMMENTS.match(content).end():
+        return None
+
+    index = {}
+    for i, (start, line) in enumerate(lines):
+        match = TOP_LEVEL_KEY.match(line)
+        if match is None:
+            return None
+        value = line[match.end():]
+        if value.count(b'[') != value.count(b']') or value.count(b'{') != value.count(b'}'):
+            return None
+        key = match.group(1).decode('utf-8')
+        key = key if PLAIN_KEY.match(key) and key.lower() not in YAML_RESERVED else yaml_load(key)
+        if key in index:
+            return None
+        index[key] = (start, lines[i + 1][0] if i + 1 < len(lines) else len(content))
+
+    stat = os.stat(filename)
+    stat = (stat.st_mtime_ns, stat.st_size)
+    return {key: offsets + (stat,) for key, offsets in index.items()}
+
+
+def load_yaml_chunk(filename, start, end, stat, key):
+    current = os.stat(filename)
+    if (current.st_mtime_ns, current.st_size) != stat:
+        LOGGER.warning('[load_yaml_chunk] %s changed since indexed, parse whole file for %s', filename, key)
+        return {key: load_yaml(filename)[key]}
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    try:
+        data = yaml_load(chunk)
+    except Exception as e:
+        data = e
+    if not isinstance(data, dict) or list(data.keys()) != [key]:
+        LOGGER.warning('[load_yaml_chunk] failed to parse %s of %s alone, parse whole file', key, filename)
+        return {key: load_yaml(filename)[key]}
+    return data
+
+
+def _unclosed_quote(content):
+    # True when a key, value or list item opens a quoted scalar that does not end on the same line
+    for match in QUOTED_START.finditer(content):
+        if QUOTED_REST[match.group(1)].match(content, match.end()) is None:
+            return True
+    return False
+
+
+def _attach_untracked(shared_memory, name):
+    # before 3.13 attaching registers the segment with this process's resource tracker, which unlinks it when the
+    # process exits; the owner unlinks it in unshare(). Registration is skipped rather than undone afterwards,
+    # since forked children share the owner's tracker and an unregister would drop the owner's entry too.
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+
+    def register_untracked(name, rtype):
+        if rtype != 'shared_memory':
+            register(name, rtype)
+    resource_tracker.register = register_untracked
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def load_shared_chunk(shm, start, end, key):
+    return {key: pickle.loads(shm.buf[start:end])}
+
+
+def write_atomic(filename, content):
+    temp_path = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+    with open(temp_path, 'wb' if isinstance(content, bytes) else 'w') as f:
+        f.write(content)
+    os.replace(temp_path, filename)
+
+
+def load_yamls(filenames, cache_dir=None, max_workers=None):
+    # sequential unless max_workers is given: parsing holds the GIL, so threads only pay off when reading the files
+    # waits on slow storage. Results keep the given order so merging stays deterministic
+    if len(filenames) < 2 or not max_workers or max_workers == 1:
+        return [load_yaml(filename, cache_dir=cache_dir) for filename in filenames]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda filename: load_yaml(filename, cache_dir=cache_dir), filenames))
 
 
 def update_dict(dict1, dict2):
@@ -143,8 +1058,77 @@ def update_dict(dict1, dict2):
             dict1[key] = value
 
 
+def merge_dicts(trees):
+    merged = {}
+    for tree in trees:
+        update_dict(merged, copy.deepcopy(tree))
+    return merged
+
+
+def diff_dict(old, new, keys=()):
+    # {keys: (old, new)} for every leaf that differs; a missing value is None
+    diff = {}
+    for key in list(old.keys()) + [key for key in new.keys() if key not in old]:
+        before, after = old.get(key), new.get(key)
+        if isinstance(before, dict) and isinstance(after, dict):
+            diff.update(diff_dict(before, after, keys + (key,)))
+        elif key not in new or key not in old or before != after:
+            diff[keys + (key,)] = (before, after)
+    return diff
+
+
+def _walk(tree, path):
+    # (keys, value) at a dotted path, list items by index; None when missing
+    keys, value = (), tree
+    for key in path.split('.'):
+        if isinstance(value, dict) and key in value:
+            pass
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            key = int(key)
+        else:
+            return None
+        keys += (key,)
+        value = value[key]
+    return keys, value
+
+
+def _has_template(found):
+    stack = [found[1]] if found is not None else []
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            if '${' in value:
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return False
+
+
+def _file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _leaf_keys(keys, values):
+    if isinstance(values, dict) and values:
+        for key, value in values.items():
+            for leaf in _leaf_keys(keys + [key], value):
+                yield leaf
+    else:
+        yield keys
+
+
+def _namedtuple_keys(data):
+    return [k for k in data.keys() if not k.startswith('_') and not keyword.iskeyword(k)]
+
+
 def dict_to_namedtuple(typename, data):
-    keys = [k for k in data.keys() if not k.startswith('_') and k not in keyword.kwlist]
+    keys = _namedtuple_keys(data)
     return namedtuple(typename, keys)(
-        *(dict_to_namedtuple(typename + '_' + k, v) if isinstance(v, dict) else v for k, v in data.items() if k in keys)
+        *(dict_to_namedtuple(typename + '_' + k, data[k]) if isinstance(data[k], dict) else data[k] for k in keys)
     )
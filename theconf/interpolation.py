@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import re
+import ast
+import copy
+import operator
+from functools import lru_cache
+
+from .config import _walk
+
+
+TEMPLATE = re.compile(r'\$(\$?)\{([^{}]*)\}')
+REFERENCE = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_\-]*(?:\.[A-Za-z0-9_\-]+)*)\s*$')
+OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+    ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_,
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+_RESTORED = object()
+FUNCTIONS = {'min': min, 'max': max, 'abs': abs, 'round': round, 'int': int, 'float': float, 'str': str, 'len': len}
+
+
+class InterpolationError(ValueError):
+    pass
+
+
+class Interpolation():
+    """Dependency graph of the ${...} templates in a config tree.
+
+    Every string with ${...} is a node that references dotted paths. The nodes of a subtree are evaluated when it
+    is loaded (on first access with lazy=True), in dependency order and each once, and the value replaces the
+    template in the tree. The walk keeps its own stack, so long chains do not hit the recursion limit. When paths are written again, only the nodes under them or depending
+    on them are evaluated again, so the cost follows the number of references involved, not the tree size.
+    """
+    def __init__(self, root, lookup):
+        self.root = root                # top-level key -> the tree the values are written to
+        self.lookup = lookup            # dotted path -> value, KeyError when missing
+        self.nodes = {}                 # path -> (keys, evaluate, references, template)
+        self.values = {}                # path -> evaluated value
+        self.dependents = {}            # reference -> {node path}
+        self.nodes_under = {}           # path -> {node paths below it}
+        self.references_under = {}      # path -> {references below it}
+        self.active = set()
+
+    def changed(self, paths):
+        """Re-reads the written paths and evaluates the templates found under them and every node depending on
+        them; returns the paths of the evaluated nodes."""
+        pending = set()
+        for path in paths:
+            root = self.root(path.split('.', 1)[0])
+            # a template whose value was replaced is overridden; one still holding its value is kept
+            for node in [path] + list(self.nodes_under.get(path, ())):
+                if node in self.nodes and not self._current(node, root):
+                    self._remove(node)
+            found = _walk(root, path)
+            if found is not None:
+                for keys, text in scan(*found):
+                    # kept nodes may hold a literal ${...} from an escape
+                    if '.'.join(str(key) for key in keys) not in self.nodes:
+                        pending.add(self._add(keys, text))
+
+        queue = list(paths) + list(pending)
+        while queue:
+            for dependent in self._dependents_of(queue.pop()):
+                if dependent not in pending:
+                    pending.add(dependent)
+                    queue.append(dependent)
+        for path in pending:
+            self.values.pop(path, None)
+        self.resolve(pending)
+        return list(pending)
+
+    def resolve(self, paths):
+        for start in paths:
+            if start in self.values or start not in self.nodes:
+                continue
+            self.active.add(start)
+            stack = [(start, self._requires(start))]
+            try:
+                while stack:
+                    path, requires = stack[-1]
+                    for required in requires:
+                        if required in self.values:
+                            continue
+                        if required in self.active:
+                            chain = [frame[0] for frame in stack]
+                            chain = chain[chain.index(required):] if required in chain else chain[-1:]
+                            raise InterpolationError('cycle in config references: %s' % ' -> '.join(chain + [required]))
+                        self.active.add(required)
+                        stack.append((required, self._requires(required)))
+                        break
+                    else:
+                        stack.pop()
+                        self._evaluate(path)
+                        self.active.discard(path)
+            except Exception:
+                for path, _ in stack:
+                    self.active.discard(path)
+                raise
+
+    def templates(self):
+        return {path: node[3] for path, node in self.nodes.items()}
+
+    def restore(self, templates):
+        # nodes of a tree whose values were already evaluated elsewhere (Config.share)
+        for path, text in templates.items():
+            self._add(tuple(int(key) if key.isdigit() else key for key in path.split('.')), text)
+            self.values[path] = _RESTORED
+
+    def evaluate(self, text):
+        evaluate, _ = compile_template(text)
+        return evaluate(self._lookup)
+
+    def _current(self, path, root):
+        value = self.values.get(path, _RESTORED)
+        if value is _RESTORED:
+            return path in self.values
+        found = _walk(root, path)
+        return found is not None and found[1] is value
+
+    def _lookup(self, path):
+        if path in self.nodes and path not in self.values:
+            self.resolve([path])
+        return self.lookup(path)
+
+    def _evaluate(self, path):
+        keys, evaluate, _, _ = self.nodes[path]
+        try:
+            value = evaluate(self._lookup)
+        except InterpolationError:
+            raise
+        except KeyError as e:
+            raise InterpolationError('%s: unknown reference %s' % (path, e))
+        except Exception as e:
+            raise InterpolationError('%s: %s:%s' % (path, type(e).__name__, str(e)))
+        parent = self.root(keys[0])
+        for key in keys[:-1]:
+            parent = parent[key]
+        parent[keys[-1]] = value
+        self.values[path] = value
+
+    def _requires(self, path):
+        # template nodes a node has to wait for: the referenced node, the nodes below it and the node above it
+        for reference in self.nodes[path][2]:
+            if reference in self.nodes:
+                yield reference
+            for node in self.nodes_under.get(reference, ()):
+                yield node
+            for prefix in _prefixes(reference):
+                if prefix in self.nodes:
+                    yield prefix
+
+    def _dependents_of(self, path):
+        for reference in [path] + _prefixes(path) + list(self.references_under.get(path, ())):
+            for dependent in self.dependents.get(reference, ()):
+                yield dependent
+
+    def _add(self, keys, text):
+        path = '.'.join(str(key) for key in keys)
+        evaluate, references = compile_template(text)
+        self.nodes[path] = (keys, evaluate, references, text)
+        for prefix in _prefixes(path):
+            self.nodes_under.setdefault(prefix, set()).add(path)
+        for reference in references:
+            self.dependents.setdefault(reference, set()).add(path)
+            for prefix in _prefixes(reference):
+                self.references_under.setdefault(prefix, set()).add(reference)
+        return path
+
+    def _remove(self, path):
+        _, _, references, _ = self.nodes.pop(path)
+        self.values.pop(path, None)
+        for prefix in _prefixes(path):
+            self.nodes_under[prefix].discard(path)
+        for reference in references:
+            self.dependents[reference].discard(path)
+
+
+def _prefixes(path):
+    # 'a.b.c' -> ['a', 'a.b']
+    prefixes, position = [], path.find('.')
+    while position >= 0:
+        prefixes.append(path[:position])
+        position = path.find('.', position + 1)
+    return prefixes
+
+
+def scan(keys, value):
+    # (keys, string) for every string with ${...} in a value, lists included
+    stack = [(keys, value)]
+    while stack:
+        keys, value = stack.pop()
+        if isinstance(value, str):
+            if '${' in value:
+                yield keys, value
+        elif isinstance(value, dict):
+            stack.extend((keys + (key,), item) for key, item in value.items())
+        elif isinstance(value, list):
+            stack.extend((keys + (i,), item) for i, item in enumerate(value))
+
+
+@lru_cache(maxsize=4096)
+def compile_template(text):
+    """Compiles a string with ${...} into (evaluate(lookup), references).
+
+    A string that is a single ${...} evaluates to the value itself, so '${train.batch}' stays an int and a
+    referenced subtree is copied; otherwise the parts are joined into a string. $${...} is a literal ${...}.
+    """
+    parts, references, position = [], [], 0
+    for match in TEMPLATE.finditer(text):
+        if match.start() > position:
+            parts.append(text[position:match.start()])
+        position = match.end()
+        if match.group(1):
+            parts.append(match.group(0)[1:])
+            continue
+        evaluate, expression_references = compile_expression(match.group(2))
+        parts.append(evaluate)
+        references.extend(expression_references)
+    if position < len(text):
+        parts.append(text[position:])
+
+    if len(parts) == 1 and callable(parts[0]):
+        return parts[0], references
+
+    def evaluate(lookup):
+        return ''.join(part if isinstance(part, str) else str(part(lookup)) for part in parts)
+    return evaluate, references
+
+
+def compile_expression(source):
+    """A dotted path ('model.lr', dashed keys allowed) or a simple expression over dotted paths:
+    arithmetic, comparisons, `a if cond else b` and min, max, abs, round, int, float, str, len."""
+    match = REFERENCE.match(source)
+    if match:
+        path = match.group(1)
+
+        def reference(lookup):
+            value = lookup(path)
+            return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+        return reference, [path]
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as e:
+        raise InterpolationError('invalid expression ${%s}: %s' % (source, e.msg))
+    references = []
+    return _compile_node(tree.body, source, references), references
+
+
+def _compile_node(node, source, references):
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return lambda lookup: value
+    path = _dotted(node)
+    if path is not None:
+        references.append(path)
+        return lambda lookup: lookup(path)
+    if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        op = OPERATORS[type(node.op)]
+        left, right = _compile_node(node.left, source, references), _compile_node(node.right, source, references)
+        return lambda lookup: op(left(lookup), right(lookup))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+        op, operand = OPERATORS[type(node.op)], _compile_node(node.operand, source, references)
+        return lambda lookup: op(operand(lookup))
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in OPERATORS:
+        op = OPERATORS[type(node.ops[0])]
+        left, right = _compile_node(node.left, source, references), _compile_node(node.comparators[0], source, references)
+        return lambda lookup: op(left(lookup), right(lookup))
+    if isinstance(node, ast.IfExp):
+        test = _compile_node(node.test, source, references)
+        body, orelse = _compile_node(node.body, source, references), _compile_node(node.orelse, source, references)
+        return lambda lookup: body(lookup) if test(lookup) else orelse(lookup)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+        function = FUNCTIONS[node.func.id]
+        arguments = [_compile_node(argument, source, references) for argument in node.args]
+        return lambda lookup: function(*[argument(lookup) for argument in arguments])
+    raise InterpolationError('unsupported expression ${%s}' % source)
+
+
+def _dotted(node):
+    names = []
+    while isinstance(node, ast.Attribute):
+        names.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    names.append(node.id)
+    return '.'.join(reversed(names))
@@ -1,96 +1,467 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=arguments-differ, abstract-method
 from __future__ import absolute_import
-import os
+import math
+import time
+import queue
 import logging
+import threading
+from collections import namedtuple
 
-import mlflow as module_mlflow
 import torch
-from torch.utils.tensorboard import SummaryWriter
+import torch.distributed as dist
+
+from .sinks import MetricRecord, TensorBoardSink, MlflowSink
 
 
 LOGGER = logging.getLogger(__name__)
+LogRecord = namedtuple('LogRecord', ['prefix', 'step', 'timestamp', 'names', 'positions', 'snapshot', 'targets'])
 
 
 class AverageMeter(torch.nn.Module):
-    def __init__(self, *keys, tensorboard_path=None, prefixs=['train', 'valid']):
+    STORAGE = ('_sums', '_counts', '_sketch', '_sketch_values', '_quantile_rows', '_quantile_q', '_ema', '_ema_rate',
+               '_ring', '_ring_length', '_ring_next', '_best', '_best_step', '_best_sign')
+
+    def __init__(self, *keys, tensorboard_path=None, prefixs=['train', 'valid'], sinks=(), quantiles={}, ema={},
+                 windows={}, best_modes={}, relative_accuracy=0.01, value_range=(1e-6, 1e6), background=False, max_queue=1024,
+                 overflow='block', batch_size=256):
         super(AverageMeter, self).__init__()
         self.step = 0
         self.keys = keys
+        self._index = {key: i for i, key in enumerate(keys)}
+        self._sums = torch.zeros(len(keys), dtype=torch.float)
+        self._counts = torch.zeros(len(keys), dtype=torch.int32)
+        self._init_accumulators(quantiles, ema, windows, relative_accuracy, value_range)
+        self._init_best(best_modes)
+        self._register_views()
         self.reset()
 
+        # tensorboard and mlflow are sinks like any other, imported only when they are used
         self.tensorboard_path = tensorboard_path
-        if tensorboard_path:
-            self.writers = {prefix: SummaryWriter(os.path.join(tensorboard_path, prefix)) for prefix in prefixs}
-        else:
-            self.writers = {}
+        self._tensorboard = TensorBoardSink(tensorboard_path, prefixs) if tensorboard_path else None
+        self._mlflow = None
+        self.sinks = list(sinks)
 
-    def reset(self, step=None):
+        # with background, log() only enqueues a snapshot and a worker thread writes to the sinks
+        if overflow not in ('block', 'drop_newest', 'drop_oldest'):
+            raise ValueError('unknown overflow policy: %s' % overflow)
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue, self._thread = None, None
+        if background:
+            self._queue = queue.Queue(maxsize=max_queue)
+            self._thread = threading.Thread(target=self._run, name='AverageMeter', daemon=True)
+            self._thread.start()
+
+    def reset(self, step=None, keys=None):
         self.step = step if step is not None else self.step + 1
 
+        # zeroed in place: buffers keep their identity and nothing is allocated
+        # EMAs and last-N windows are not cleared, they already forget old values on their own
+        if keys is None:
+            self._sums.zero_()
+            self._counts.zero_()
+            self._sketch.zero_()
+        else:
+            index, _ = self._index_tensors(tuple(keys))
+            self._sums.index_fill_(0, index, 0)
+            self._counts.index_fill_(0, index, 0)
+            rows = [self._sketch_rows[key] for key in keys if key in self._sketch_rows]
+            if rows:
+                self._sketch.index_fill_(0, torch.tensor(rows, device=self._sketch.device), 0)
+
+    def _init_accumulators(self, quantiles, ema, windows, relative_accuracy, value_range):
+        # quantiles come from a DDSketch-style histogram with logarithmic buckets, so memory is fixed per key and
+        # every quantile is within relative_accuracy of the true value inside value_range
+        windows = {key: (sizes,) if isinstance(sizes, int) else tuple(sizes) for key, sizes in windows.items()}
+        unknown = (set(quantiles) | set(ema) | set(windows)) - set(self.keys)
+        if unknown:
+            raise ValueError('unknown keys: %s' % ', '.join(sorted(unknown)))
+        if any(not 0.0 <= q <= 1.0 for qs in quantiles.values() for q in qs):
+            raise ValueError('quantiles must be in [0, 1]')
+        if any(not 0.0 <= decay < 1.0 for decay in ema.values()):
+            raise ValueError('ema decay must be in [0, 1)')
+        if any(size < 1 for sizes in windows.values() for size in sizes):
+            raise ValueError('window sizes must be positive')
+
+        sketch_keys = [key for key in self.keys if quantiles.get(key)]
+        ema_keys = [key for key in self.keys if key in ema]
+        self._sketch_rows = {key: i for i, key in enumerate(sketch_keys)}
+        self._ema_rows = {key: i for i, key in enumerate(ema_keys)}
+
+        gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self._log_gamma = math.log(gamma)
+        self._min_value = value_range[0]
+        self._half = int(math.ceil(math.log(value_range[1] / value_range[0]) / self._log_gamma)) + 1
+        magnitudes = value_range[0] * 2.0 / (1.0 + gamma) * gamma ** torch.arange(self._half, dtype=torch.double)
+        self._sketch_values = torch.cat((-magnitudes.flip(0), torch.zeros(1, dtype=torch.double), magnitudes))
+        self._sketch = torch.zeros(len(sketch_keys), 2 * self._half + 1, dtype=torch.double)
+
+        # biased average and its total weight, their ratio is the bias corrected EMA
+        self._ema = torch.zeros(len(ema_keys), 2, dtype=torch.double)
+        self._ema_rate = 1.0 - torch.tensor([ema[key] for key in ema_keys], dtype=torch.double)
+
+        # one ring buffer row of (value * n, n) per key and window size, padded to the largest window
+        ring = [(key, size) for key in self.keys for size in windows.get(key, ())]
+        self._ring_rows = {}
+        for i, (key, _) in enumerate(ring):
+            self._ring_rows.setdefault(key, []).append(i)
+        self._ring = torch.zeros(len(ring), max([size for _, size in ring], default=0), 2, dtype=torch.double)
+        self._ring_length = torch.tensor([size for _, size in ring], dtype=torch.long)
+        self._ring_next = torch.zeros(len(ring), dtype=torch.long)
+
+        # all of them are read as one vector: quantile entries, then one entry per EMA key, then one per window
+        entries = [(key, q) for key in sketch_keys for q in quantiles[key]]
+        self._quantile_rows = torch.tensor([self._sketch_rows[key] for key, _ in entries], dtype=torch.long)
+        self._quantile_q = torch.tensor([q for _, q in entries], dtype=torch.double)
+        offsets = {(key, q): i for i, (key, q) in enumerate(entries)}
+        self._stats, self._windows = {}, {}
         for key in self.keys:
-            device = self._buffers[key].device if key in self._buffers else torch.device('cpu')
-            self.register_buffer(key, torch.zeros(1, dtype=torch.float, device=device))
-            self.register_buffer(key + '_count', torch.zeros(1, dtype=torch.int32, device=device))
+            for q in quantiles.get(key, ()):
+                self._stats['%s_p%g' % (key, q * 100)] = offsets[(key, q)]
+            if key in self._ema_rows:
+                self._stats[key + '_ema'] = len(entries) + self._ema_rows[key]
+            for size, row in zip(windows.get(key, ()), self._ring_rows.get(key, ())):
+                self._windows['%s_last%d' % (key, size)] = row
+                self._stats['%s_last%d' % (key, size)] = len(entries) + len(ema_keys) + row
 
-    def log(self, prefix, step=None, tensorboard=True, mlflow=False, keep_best_keys=[], with_best=False):
-        step = step if step is not None else self.step
+    def _init_best(self, best_modes):
+        # best averages and the step they were logged at, for every key up front so log() never allocates;
+        # a step of -1 means no best yet
+        if set(best_modes) - set(self.keys):
+            raise ValueError('unknown keys: %s' % ', '.join(sorted(set(best_modes) - set(self.keys))))
+        if any(mode not in ('min', 'max') for mode in best_modes.values()):
+            raise ValueError('best mode must be min or max')
+        self._best = torch.zeros(len(self.keys), dtype=torch.double)
+        self._best_step = torch.full((len(self.keys),), -1, dtype=torch.long)
+        self._best_sign = torch.tensor([-1.0 if best_modes.get(key) == 'min' else 1.0 for key in self.keys],
+                                       dtype=torch.double)
+        self._best_keys = [key for key in self.keys if key in best_modes]
+        self._best_names = {}
+        for key, i in self._index.items():
+            self._best_names[key + '_best'] = i
+            self._best_names[key + '_best_step'] = len(self.keys) + i
+
+    def _register_views(self):
+        # every key and key_count buffer is a view into the packed storage, so state_dict keeps its layout
+        self._index_cache = {}
+        self._accumulator_cache = {}
+        for key, i in self._index.items():
+            self.register_buffer(key, self._sums[i:i + 1])
+            self.register_buffer(key + '_count', self._counts[i:i + 1])
+        for key, i in self._sketch_rows.items():
+            self.register_buffer(key + '_sketch', self._sketch[i])
+        for key, i in self._ema_rows.items():
+            self.register_buffer(key + '_ema_state', self._ema[i])
+        for name, row in self._windows.items():
+            self.register_buffer(name + '_state', self._ring[row])
+            self.register_buffer(name + '_next', self._ring_next[row:row + 1])
+        for key in self._best_keys:
+            self._register_best(key)
 
-        for key in keep_best_keys:
-            if key not in self._buffers:
-                continue
-            best_key = key + '_best'
-            device = self._buffers[key].device if key in self._buffers else torch.device('cpu')
-            last_value = self._buffers[best_key] if best_key in self._buffers else torch.zeros(1, dtype=torch.float, device=device)
-            last_count = self._buffers[best_key + '_count'] if best_key in self._buffers else torch.zeros(1, dtype=torch.float, device=device)
+    def _register_best(self, key):
+        # only keys that ever tracked a best appear in state_dict
+        i = self._index[key]
+        self.register_buffer(key + '_best', self._best[i:i + 1])
+        self.register_buffer(key + '_best_step', self._best_step[i:i + 1])
 
-            value = max(last_value, self._buffers[key])
-            count = max(last_count, self._buffers[key + '_count'])
+    def _apply(self, fn, *args, **kwargs):
+        super(AverageMeter, self)._apply(fn, *args, **kwargs)
+        for name in self.STORAGE:
+            setattr(self, name, fn(getattr(self, name)))
+        self._register_views()
+        return self
+
+    def log(self, prefix, step=None, tensorboard=True, mlflow=False, keep_best_keys=[], with_best=False, reduce=False):
+        step = step if step is not None else self.step
 
-            self.register_buffer(best_key, value)
-            self.register_buffer(best_key + '_count', count)
+        best_keys = tuple(key for key in keep_best_keys if key in self._index)
+        for key in best_keys:
+            if key not in self._best_keys:
+                self._best_keys.append(key)
+                self._register_best(key)
 
-        if self.tensorboard_path and tensorboard:
-            for key, value in self.get(with_best=with_best).items():
-                self.writers[prefix].add_scalar('metrics/%s' % key, value, global_step=step)
+        # with reduce every rank takes part in the collective but only rank 0 writes
+        names = self._names(with_best=True)
+        positions, snapshot = self._snapshot(names, reduce=reduce, best=(best_keys, step))
+        if reduce and dist.is_available() and dist.is_initialized() and dist.get_rank() != 0:
+            return
 
+        keys = self._names(with_best=with_best)
+        targets = [(sink, keys) for sink in self.sinks]
+        if self._tensorboard is not None and tensorboard:
+            targets.append((self._tensorboard, keys))
         if mlflow:
-            module_mlflow.log_metrics(self.get(prefix=prefix), step=step)
+            if self._mlflow is None:
+                self._mlflow = MlflowSink()
+            targets.append((self._mlflow, self._names()))
+        targets = [(sink, keys, sink.context()) for sink, keys in targets]
+
+        record = LogRecord(prefix, step, int(time.time() * 1000), names, positions, snapshot, targets)
+        if self._queue is None:
+            self._write([record])
+        else:
+            self._enqueue(record)
+
+    def _sinks(self):
+        return self.sinks + [sink for sink in (self._tensorboard, self._mlflow) if sink is not None]
+
+    def _write(self, records):
+        # every sink gets all of its records in one call
+        batches = {}
+        for record in records:
+            averages = snapshot_averages(record.names, record.positions, record.snapshot)
+            for sink, keys, context in record.targets:
+                metrics = {key: averages[key] for key in keys}
+                batches.setdefault(id(sink), (sink, []))[1].append(
+                    MetricRecord(record.prefix, record.step, record.timestamp, metrics, context))
+
+        for sink, sink_records in batches.values():
+            sink.write(sink_records)
+
+    def _enqueue(self, record):
+        if self.overflow == 'block':
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == 'drop_oldest':
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                except queue.Empty:
+                    pass
+                self._queue.put_nowait(record)
+            self.dropped += 1
+            LOGGER.debug('[AverageMeter] log queue is full, %d records dropped', self.dropped)
+
+    def _run(self):
+        # drains everything queued so far so a slow sink gets few large batches
+        while True:
+            records = [self._queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(record is None for record in records)
+            try:
+                self._write([record for record in records if record is not None])
+            except Exception as e:
+                LOGGER.warning('[AverageMeter] failed to write logs %s:%s', type(e), str(e))
+            for _ in records:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        if self._queue is not None:
+            self._queue.join()
+        for sink in self._sinks():
+            sink.flush()
 
     def close(self, mlflow=False):
-        for prefix, writer in self.writers.items():
-            writer.flush()
-            writer.close()
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue, self._thread = None, None
+        for sink in self._sinks():
+            sink.close()
         if mlflow:
+            import mlflow as module_mlflow
             module_mlflow.end_run()
 
     def update(self, key, value, n=1):
         if isinstance(value, torch.Tensor):
             value = value.detach()
 
+        # statistics first, so a failure there leaves the sums untouched
+        if key in self._sketch_rows or key in self._ema_rows or key in self._ring_rows:
+            with torch.no_grad():
+                self._accumulate((key,), torch.as_tensor(value, dtype=torch.double, device=self._sums.device).reshape(1), n)
         self._buffers[key] += value * n
         self._buffers[key + '_count'] += n
         return self
 
+    def _index_tensors(self, keys):
+        cached = self._index_cache.get(keys)
+        if cached is None:
+            index = torch.tensor([self._index[key] for key in keys], dtype=torch.long, device=self._sums.device)
+            cached = self._index_cache[keys] = (index, torch.ones(len(keys), dtype=self._counts.dtype, device=self._counts.device))
+        return cached
+
     def updates(self, dictionary, n=1):
-        for key, value in dictionary.items():
-            self.update(key, value, n)
+        # one indexed add over the packed storage instead of two small ops per key
+        if not dictionary:
+            return self
+        keys = tuple(dictionary.keys())
+        index, ones = self._index_tensors(keys)
+
+        with torch.no_grad():
+            try:
+                values = torch.cat(tuple(dictionary.values()))
+            except (RuntimeError, TypeError):
+                values = None
+            if values is None or values.numel() != len(keys):
+                values = torch.stack([torch.as_tensor(value).reshape(()).to(self._sums.device) for value in dictionary.values()])
+            values = values.to(device=self._sums.device, dtype=self._sums.dtype)
+
+            if self._sketch_rows or self._ema_rows or self._ring_rows:
+                self._accumulate(keys, values, n)
+            if isinstance(n, torch.Tensor):
+                self._sums.index_add_(0, index, values * n.to(values.device))
+                self._counts.index_add_(0, index, ones * n.to(ones))
+            else:
+                self._sums.index_add_(0, index, values, alpha=n)
+                self._counts.index_add_(0, index, ones, alpha=n)
         return self
 
-    def get(self, prefix=None, with_best=False):
-        keys = [key for key in self._buffers.keys() if '_count' not in key]
-        if not with_best:
-            keys = [key for key in keys if '_best' not in key]
+    def _accumulator_tensors(self, keys):
+        cached = self._accumulator_cache.get(keys)
+        if cached is None:
+            def positions_and_rows(rows):
+                pairs = [(i, row) for i, key in enumerate(keys) for row in rows.get(key, ())]
+                return tuple(torch.tensor([pair[j] for pair in pairs], dtype=torch.long, device=self._sums.device)
+                             for j in (0, 1))
+            cached = self._accumulator_cache[keys] = (
+                positions_and_rows({key: (row,) for key, row in self._sketch_rows.items()}),
+                positions_and_rows({key: (row,) for key, row in self._ema_rows.items()}),
+                positions_and_rows(self._ring_rows))
+        return cached
+
+    def _buckets(self, values):
+        # exact zeros get the middle bucket, magnitudes outside value_range are clamped to the outermost buckets
+        magnitudes = values.abs().log_().sub_(math.log(self._min_value)).div_(self._log_gamma).ceil_()
+        magnitudes = magnitudes.clamp_(0, self._half - 1).add_(1).mul_(values.sign()).add_(self._half)
+        return magnitudes.long()
+
+    def _accumulate(self, keys, values, n):
+        # sketches take one flat index_add_, EMAs one gather and one scatter, windows one scatter into their ring
+        # buffers, whatever the number of keys
+        (sketch_positions, sketch_rows), (ema_positions, ema_rows), (ring_positions, ring_rows) = \
+            self._accumulator_tensors(keys)
+        values = values.to(dtype=torch.double)
+        if sketch_rows.numel():
+            observed = values.index_select(0, sketch_positions)
+            # nan and inf have no bucket: they are left out of the sketch (means and EMAs still see them)
+            finite = observed.isfinite()
+            weights = self._weights(observed, n).masked_fill(~finite, 0)
+            observed = observed.masked_fill(~finite, 0)
+            flat = sketch_rows * self._sketch.shape[1] + self._buckets(observed)
+            self._sketch.view(-1).index_add_(0, flat, weights)
+        if ema_rows.numel():
+            observed = values.index_select(0, ema_positions)
+            target = torch.stack((observed, torch.ones_like(observed)), dim=1)
+            state = self._ema.index_select(0, ema_rows)
+            state.lerp_(target, self._ema_rate.index_select(0, ema_rows).unsqueeze(1))
+            self._ema.index_copy_(0, ema_rows, state)
+        if ring_rows.numel():
+            observed = values.index_select(0, ring_positions)
+            weights = self._weights(observed, n)
+            slots = self._ring_next.index_select(0, ring_rows).remainder_(self._ring_length.index_select(0, ring_rows))
+            flat = ring_rows * self._ring.shape[1] + slots
+            self._ring.view(-1, 2).index_copy_(0, flat, torch.stack((observed * weights, weights), dim=1))
+            self._ring_next.index_add_(0, ring_rows, torch.ones_like(ring_rows))
+
+    @staticmethod
+    def _weights(observed, n):
+        return n.to(observed).expand_as(observed) if isinstance(n, torch.Tensor) else torch.full_like(observed, n)
+
+    def _names(self, with_best=False):
+        names = list(self.keys) + list(self._stats)
+        if with_best:
+            names += [name for key in self.keys if key in self._best_keys for name in (key + '_best', key + '_best_step')]
+        return names
+
+    def sync(self, group=None):
+        # sums and counts over all ranks with one all_reduce of a single packed buffer; local storage is untouched
+        return self._state(reduce=True, group=group)[:2]
+
+    def _state(self, reduce=False, stats=False, group=None):
+        # sketches, EMA states and window totals are merged by summing too, so they share the collective
+        tensors = (self._sums, self._counts) + ((self._sketch, self._ema, self._ring.sum(dim=1)) if stats else ())
+        if not (reduce and dist.is_available() and dist.is_initialized()):
+            return [tensor.double() for tensor in tensors]
+        packed = torch.cat([tensor.double().reshape(-1) for tensor in tensors])
+        dist.all_reduce(packed, group=group)
+        return [part.reshape(tensor.shape) for part, tensor in zip(packed.split([t.numel() for t in tensors]), tensors)]
+
+    def _stat_values(self, sketch, ema, windows):
+        # quantiles, EMAs and windows as (value, count) pairs so snapshot_averages reads them like means
+        sums, counts = [ema[:, 0], windows[:, 0]], [ema[:, 1], windows[:, 1]]
+        if self._quantile_rows.numel():
+            cdf = sketch.cumsum(dim=1).index_select(0, self._quantile_rows)
+            totals = cdf[:, -1]
+            ranks = self._quantile_q * (totals - 1).clamp(min=0)
+            buckets = torch.searchsorted(cdf, ranks.unsqueeze(1), right=True).squeeze(1).clamp_(max=cdf.shape[1] - 1)
+            sums.insert(0, self._sketch_values.index_select(0, buckets))
+            counts.insert(0, (totals > 0).double())
+        return torch.cat(sums), torch.cat(counts)
+
+    def _update_best(self, sums, counts, keys, step):
+        # compares averages, ties keep the earlier step
+        index, _ = self._index_tensors(keys)
+        totals = counts.index_select(0, index)
+        averages = sums.index_select(0, index) / totals.clamp(min=1)
+        sign = self._best_sign.index_select(0, index)
+        best = self._best.index_select(0, index)
+        best_step = self._best_step.index_select(0, index)
+        better = (totals > 0) & ((best_step < 0) | (averages * sign > best * sign))
+        self._best.index_copy_(0, index, torch.where(better, averages, best))
+        self._best_step.index_copy_(0, index, best_step.masked_fill_(better, step))
+
+    def _snapshot(self, names, reduce=False, best=None):
+        # copies the requested sums and counts into one 2 x N tensor without leaving the device
+        stats = any(name in self._stats for name in names)
+        state = self._state(reduce=reduce, stats=stats)
+        sums, counts = state[:2]
+        if best is not None and best[0]:
+            self._update_best(sums, counts, *best)
+        positions = dict(self._index)
+        if stats:
+            stat_sums, stat_counts = self._stat_values(*state[2:])
+            positions.update((name, len(sums) + offset) for name, offset in self._stats.items())
+            sums, counts = torch.cat((sums, stat_sums)), torch.cat((counts, stat_counts))
+        if any(name in self._best_names for name in names):
+            found = (self._best_step >= 0).double()
+            positions.update((name, len(sums) + offset) for name, offset in self._best_names.items())
+            sums = torch.cat((sums, self._best, self._best_step.double()))
+            counts = torch.cat((counts, found, found))
+        return [positions[name] for name in names], torch.stack((sums, counts))
+
+    def _averages(self, names, reduce=False):
+        # a single device to host transfer for all requested metrics
+        if not names:
+            return {}
+        return snapshot_averages(names, *self._snapshot(names, reduce=reduce))
+
+    def get(self, prefix=None, with_best=False, reduce=False):
+        averages = self._averages(self._names(with_best=with_best), reduce=reduce)
         if prefix is not None:
-            return {prefix + '_' + key: self.__getitem__(key) for key in keys}
-        return {key: self.__getitem__(key) for key in keys}
+            return {prefix + '_' + key: value for key, value in averages.items()}
+        return averages
 
     def __getitem__(self, key):
-        if key not in self._buffers:
-            return 0.0
-        if self._buffers[key + '_count'] == 0:
+        if key not in self._index and key not in self._stats and key not in self._best_names:
             return 0.0
-        return self._buffers[key].item() / self._buffers[key + '_count'].item()
+        return self._averages([key])[key]
+
+    def histogram(self, key, reduce=False):
+        # non-empty sketch buckets as (representative value, count) pairs in increasing order
+        sketch = self._state(reduce=reduce, stats=True)[2][self._sketch_rows[key]]
+        nonzero = sketch.nonzero().squeeze(1)
+        values = torch.stack((self._sketch_values.index_select(0, nonzero), sketch.index_select(0, nonzero)))
+        return [(value, count) for value, count in zip(*values.tolist())]
 
     def __str__(self, with_best=False):
         return ', '.join(['%s:%.4f' % (str(key), value) for key, value in self.get(with_best=with_best).items()])
+
+
+def snapshot_averages(names, positions, snapshot):
+    sums, counts = snapshot.tolist()
+    return {
+        name: sums[position] / counts[position] if counts[position] != 0 else 0.0
+        for name, position in zip(names, positions)
+    }
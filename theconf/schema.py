@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import json
+import pickle
+import hashlib
+import logging
+
+from .config import write_atomic
+
+
+LOGGER = logging.getLogger(__name__)
+TYPE_NAMES = {bool: 'bool', int: 'int', float: 'float', str: 'str', list: 'list', dict: 'dict', object: 'any'}
+TRUE_STRINGS = ('yes', 'true', 't', 'y', '1')
+FALSE_STRINGS = ('no', 'false', 'f', 'n', '0')
+_VALIDATED = {}
+
+
+class SchemaError(ValueError):
+    def __init__(self, errors):
+        self.errors = errors
+        super(SchemaError, self).__init__('%d config error(s):\n' % len(errors) + '\n'.join(
+            '  %s: %s' % (path or '<root>', message) for path, message in errors))
+
+
+class Schema():
+    """Types of a config tree, compiled once into nested validator closures.
+
+    A spec mirrors the config: dicts for subtrees and a type for every leaf, given as a Python type or a name:
+    'int', 'float', 'str', 'bool', 'any', 'list' or 'list[int]'. A trailing '?' ('int?') allows null or a missing
+    key. Keys starting with '_' are not checked, and keys missing from the spec are errors unless allow_extra.
+    """
+    def __init__(self, spec, allow_extra=False):
+        self.spec = normalize(spec)
+        self.allow_extra = allow_extra
+        self.fingerprint = hashlib.sha1(json.dumps([self.spec, allow_extra]).encode('utf-8')).hexdigest()
+        self._validator = self._compile(self.spec)
+
+    @classmethod
+    def infer(cls, reference, allow_extra=False):
+        # the types of a reference config, e.g. the defaults shipped with a project
+        return cls(infer_spec(reference.conf if hasattr(reference, 'conf') else reference), allow_extra=allow_extra)
+
+    def validate(self, tree, coerce=True):
+        """Checks the whole tree in one pass and raises SchemaError with every error found.
+
+        Returns [(keys, value)] for the leaves that had to be coerced (e.g. '1e-3' to 0.001); the tree itself is
+        not modified.
+        """
+        errors, coercions = [], []
+        self._validator(tree, (), errors, coercions if coerce else None)
+        if errors:
+            raise SchemaError(errors)
+        return coercions
+
+    def _compile(self, spec):
+        if isinstance(spec, dict):
+            return self._compile_dict(spec)
+        optional = spec.endswith('?')
+        name = spec.rstrip('?')
+        if name.startswith('list[') and name.endswith(']'):
+            item = self._compile(name[5:-1])
+            check = _list_checker(item)
+        elif name in CHECKERS:
+            check = CHECKERS[name]
+        else:
+            raise ValueError('unknown type in schema: %s' % spec)
+
+        def validate(value, keys, errors, coercions):
+            if value is None:
+                if not optional:
+                    errors.append((_path(keys), 'expected %s, got null' % name))
+                return value
+            return check(value, keys, errors, coercions)
+        validate.optional = optional
+        return validate
+
+    def _compile_dict(self, spec):
+        children = {key: self._compile(value) for key, value in spec.items()}
+        required = [key for key, child in children.items() if not getattr(child, 'optional', False)]
+        allow_extra = self.allow_extra
+
+        def validate(value, keys, errors, coercions):
+            if not isinstance(value, dict):
+                errors.append((_path(keys), 'expected a mapping, got %s' % _describe(value)))
+                return value
+            for key, item in value.items():
+                child = children.get(key)
+                if child is not None:
+                    coerced = child(item, keys + (key,), errors, coercions)
+                    if coercions is not None and coerced is not item:
+                        coercions.append((keys + (key,), coerced))
+                elif not allow_extra and not str(key).startswith('_'):
+                    errors.append((_path(keys + (key,)), 'unknown key'))
+            for key in required:
+                if key not in value:
+                    errors.append((_path(keys + (key,)), 'missing'))
+            return value
+        validate.optional = False
+        return validate
+
+
+def normalize(spec):
+    # python types and names to canonical names, so schemas hash the same however they were written
+    if isinstance(spec, dict):
+        return {key: normalize(value) for key, value in spec.items()}
+    if isinstance(spec, list):
+        return 'list[%s]' % normalize(spec[0]) if spec else 'list'
+    if isinstance(spec, type):
+        return TYPE_NAMES.get(spec, spec.__name__)
+    return str(spec)
+
+
+def infer_spec(tree):
+    spec = {}
+    for key, value in tree.items():
+        if str(key).startswith('_'):
+            continue
+        if isinstance(value, dict):
+            spec[key] = infer_spec(value)
+        elif isinstance(value, list):
+            spec[key] = 'list[%s]' % _infer_leaf(value[0]) if value and not isinstance(value[0], (dict, list)) else 'list'
+        else:
+            spec[key] = _infer_leaf(value)
+    return spec
+
+
+def _infer_leaf(value):
+    return 'any' if value is None else TYPE_NAMES.get(type(value), 'any')
+
+
+def _path(keys):
+    return '.'.join(str(key) for key in keys)
+
+
+def _describe(value):
+    return '%s %r' % (type(value).__name__, value) if not isinstance(value, (dict, list)) else type(value).__name__
+
+
+def _check_int(value, keys, errors, coercions):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    errors.append((_path(keys), 'expected int, got %s' % _describe(value)))
+    return value
+
+
+def _check_float(value, keys, errors, coercions):
+    if isinstance(value, float):
+        return value
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        # yaml reads 1e-3 (no dot) as a string
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    errors.append((_path(keys), 'expected float, got %s' % _describe(value)))
+    return value
+
+
+def _check_bool(value, keys, errors, coercions):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in TRUE_STRINGS + FALSE_STRINGS:
+        return value.lower() in TRUE_STRINGS
+    errors.append((_path(keys), 'expected bool, got %s' % _describe(value)))
+    return value
+
+
+def _check_str(value, keys, errors, coercions):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    errors.append((_path(keys), 'expected str, got %s' % _describe(value)))
+    return value
+
+
+def _check_list(value, keys, errors, coercions):
+    if isinstance(value, list):
+        return value
+    errors.append((_path(keys), 'expected list, got %s' % _describe(value)))
+    return value
+
+
+def _check_any(value, keys, errors, coercions):
+    return value
+
+
+def _list_checker(item):
+    def check(value, keys, errors, coercions):
+        if not isinstance(value, list):
+            errors.append((_path(keys), 'expected list, got %s' % _describe(value)))
+            return value
+        # items are checked without recording coercions, the whole list is replaced when one changed
+        coerced = [item(element, keys + (i,), errors, None) for i, element in enumerate(value)]
+        return coerced if any(new is not old for new, old in zip(coerced, value)) else value
+    return check
+
+
+CHECKERS = {'int': _check_int, 'float': _check_float, 'bool': _check_bool, 'str': _check_str, 'list': _check_list,
+            'any': _check_any, 'dict': _check_any}
+
+
+def validate(tree, schema, coerce=True, cache_dir=None):
+    """Schema.validate with a cache keyed by the hash of the schema and the tree content.
+
+    A tree that passed before is not checked again; its coercions are replayed from memory or, with cache_dir
+    (or THECONF_CACHE_DIR), from disk across launches. Failures are never cached.
+    """
+    schema = schema if isinstance(schema, Schema) else Schema(schema)
+    content = pickle.dumps((schema.fingerprint, coerce, tree), protocol=pickle.HIGHEST_PROTOCOL)
+    key = hashlib.sha1(content).hexdigest()
+    if key in _VALIDATED:
+        return pickle.loads(_VALIDATED[key])
+
+    cache_dir = cache_dir if cache_dir is not None else os.environ.get('THECONF_CACHE_DIR')
+    cache_path = os.path.join(cache_dir, 'validated-%s.pickle' % key) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = f.read()
+            coercions = pickle.loads(cached)
+            _VALIDATED[key] = cached
+            return coercions
+        except Exception as e:
+            LOGGER.debug('[validate] ignore broken cache %s %s:%s', cache_path, type(e), str(e))
+
+    coercions = schema.validate(tree, coerce=coerce)
+    # kept pickled, so replayed values are never shared with a tree that was modified since
+    _VALIDATED[key] = pickle.dumps(coercions, protocol=pickle.HIGHEST_PROTOCOL)
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            write_atomic(cache_path, _VALIDATED[key])
+        except (IOError, OSError) as e:
+            LOGGER.warning('[validate] failed to write cache %s: %s', cache_path, str(e))
+    return coercions
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import csv
+import io
+import json
+import logging
+from collections import namedtuple
+
+
+LOGGER = logging.getLogger(__name__)
+MetricRecord = namedtuple('MetricRecord', ['prefix', 'step', 'timestamp', 'metrics', 'context'])
+
+
+class Sink():
+    """Destination of AverageMeter logs.
+
+    `write` receives a list of MetricRecord, possibly many steps at once when the meter logs in the background.
+    `context` is called on the logging thread and its result travels with the record to `write`.
+    """
+    def context(self):
+        return None
+
+    def write(self, records):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class TensorBoardSink(Sink):
+    def __init__(self, path, prefixs=['train', 'valid']):
+        from torch.utils.tensorboard import SummaryWriter  # optional, imported only when used
+        self.path = path
+        self.writers = {prefix: SummaryWriter(os.path.join(path, prefix)) for prefix in prefixs}
+
+    def write(self, records):
+        for record in records:
+            writer = self.writers[record.prefix]
+            for key, value in record.metrics.items():
+                writer.add_scalar('metrics/%s' % key, value, global_step=record.step)
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.flush()
+            writer.close()
+
+
+class MlflowSink(Sink):
+    def __init__(self):
+        import mlflow  # optional, imported only when used
+        self.mlflow = mlflow
+
+    def context(self):
+        # the fluent run is thread local, so the run id is taken on the caller's thread
+        return (self.mlflow.active_run() or self.mlflow.start_run()).info.run_id
+
+    def write(self, records):
+        from mlflow.entities import Metric
+        from mlflow.tracking import MlflowClient
+
+        metrics = {}
+        for record in records:
+            metrics.setdefault(record.context, []).extend(
+                Metric(record.prefix + '_' + key, value, record.timestamp, record.step)
+                for key, value in record.metrics.items())
+        client = MlflowClient()
+        for run_id, batch in metrics.items():
+            client.log_batch(run_id, metrics=batch)
+
+
+class BufferedFileSink(Sink):
+    """Append-only file sink that keeps formatted lines in memory and writes them with a single call."""
+    def __init__(self, filename, buffer_size=1024):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self._lines = []
+
+    def format(self, record):
+        raise NotImplementedError
+
+    def header(self):
+        return ''
+
+    def write(self, records):
+        for record in records:
+            self._lines.extend(self.format(record))
+        if len(self._lines) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._lines:
+            return
+        lines, self._lines = self._lines, []
+        with open(self.filename, 'a') as f:
+            if f.tell() == 0:
+                f.write(self.header())
+            f.write(''.join(lines))
+
+
+class JsonlSink(BufferedFileSink):
+    def format(self, record):
+        return [json.dumps({'prefix': record.prefix, 'step': record.step, 'timestamp': record.timestamp,
+                            'metrics': record.metrics}) + '\n']
+
+
+class CsvSink(BufferedFileSink):
+    FIELDS = ['timestamp', 'step', 'prefix', 'key', 'value']
+
+    def header(self):
+        return ','.join(self.FIELDS) + '\r\n'
+
+    def format(self, record):
+        # long format: one row per metric, so keys may differ between records
+        output = io.StringIO()
+        writer = csv.writer(output)
+        for key, value in record.metrics.items():
+            writer.writerow([record.timestamp, record.step, record.prefix, key, value])
+        return [output.getvalue()]
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import sys
+import json
+import math
+import random
+import logging
+import argparse
+import importlib
+import itertools
+import multiprocessing
+import traceback
+
+from .config import Config, load_yaml, write_atomic
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def expand(spec):
+    """Expands a sweep spec into a list of override sets ({dotted path: value}) without duplicates.
+
+    spec:
+        method: grid | random
+        count: 10           # random only
+        seed: 0             # random only
+        parameters:
+            model.lr: [0.1, 0.01]                      # values
+            model.depth: {values: [18, 50]}
+            optimizer.momentum: {min: 0.8, max: 0.99}  # random only, integers when both bounds are
+            model.weight_decay: {min: 1.0e-5, max: 1.0e-3, log: true}
+    """
+    method = spec.get('method', 'grid')
+    parameters = [(path, _parameter(path, value)) for path, value in spec.get('parameters', {}).items()]
+
+    if method == 'grid':
+        ranges = [path for path, parameter in parameters if 'values' not in parameter]
+        if ranges:
+            raise ValueError('grid sweeps need values for: %s' % ', '.join(ranges))
+        candidates = (dict(zip([path for path, _ in parameters], values))
+                      for values in itertools.product(*[parameter['values'] for _, parameter in parameters]))
+        limit = None
+    elif method == 'random':
+        rng = random.Random(spec.get('seed'))
+        limit = spec.get('count', 1)
+        # duplicates are redrawn, a bounded number of times for small spaces
+        candidates = ({path: _sample(rng, parameter) for path, parameter in parameters} for _ in range(limit * 10))
+    else:
+        raise ValueError('unknown sweep method: %s' % method)
+
+    runs, seen = [], set()
+    for overrides in candidates:
+        fingerprint = json.dumps(overrides, sort_keys=True, default=repr)
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        runs.append(overrides)
+        if limit is not None and len(runs) == limit:
+            break
+    return runs
+
+
+def _parameter(path, value):
+    if isinstance(value, dict):
+        if 'values' not in value and not ('min' in value and 'max' in value):
+            raise ValueError('%s needs values or min and max' % path)
+        return value
+    return {'values': value if isinstance(value, list) else [value]}
+
+
+def _sample(rng, parameter):
+    if 'values' in parameter:
+        return rng.choice(parameter['values'])
+    low, high = parameter['min'], parameter['max']
+    if parameter.get('log'):
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    if isinstance(low, int) and isinstance(high, int):
+        return rng.randint(low, high)
+    return rng.uniform(low, high)
+
+
+def nest(overrides):
+    # {'model.lr': 0.1} -> {'model': {'lr': 0.1}}
+    nested = {}
+    for path, value in overrides.items():
+        keys = path.split('.')
+        parent = nested
+        for key in keys[:-1]:
+            parent = parent.setdefault(key, {})
+        parent[keys[-1]] = value
+    return nested
+
+
+def run(target, spec, config=None, output_dir=None, max_workers=None, mp_context=None):
+    """Runs target(config) once per override set on a local process pool.
+
+    The base config is published once with Config.share; every run attaches to it, applies its overrides and
+    gets the result as Config.get(), so nothing is re-parsed. With output_dir each run dumps its config to
+    run-XXXX/config.yaml and index.json lists every run with its overrides, status and the value target returned.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    runs = expand(spec)
+    config = config if config is not None else Config.get()
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    context = multiprocessing.get_context(mp_context) if mp_context else None
+
+    name = config.share()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+            futures = [executor.submit(run_one, target, name, i, overrides, output_dir)
+                       for i, overrides in enumerate(runs)]
+            summary = [future.result() for future in futures]
+    finally:
+        config.unshare()
+
+    if output_dir:
+        write_atomic(os.path.join(output_dir, 'index.json'), json.dumps(summary, indent=2, default=repr))
+    return summary
+
+
+def run_one(target, name, index, overrides, output_dir=None):
+    # runs in the worker: a fresh singleton per run, attached to the parent's snapshot
+    Config.clear()
+    config = Config.attach(name)
+    entry = {'run': index, 'overrides': overrides, 'config': None, 'status': 'ok', 'result': None}
+    try:
+        config.update(nest(overrides))
+        config['_sweep'] = {'run': index, 'overrides': overrides}
+        if output_dir:
+            entry['config'] = os.path.join(output_dir, 'run-%04d' % index, 'config.yaml')
+            os.makedirs(os.path.dirname(entry['config']), exist_ok=True)
+            config.dump(entry['config'])
+        entry['result'] = target(config)
+    except Exception as e:
+        LOGGER.warning('[sweep] run %d failed %s:%s', index, type(e), str(e))
+        entry['status'] = 'failed'
+        entry['error'] = traceback.format_exc()
+    finally:
+        config._shared.close()
+        Config.clear()
+    return entry
+
+
+def import_target(path):
+    # 'package.module:function'
+    module, _, attribute = path.partition(':')
+    return getattr(importlib.import_module(module), attribute)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='expands a sweep over a config and runs it on a process pool')
+    parser.add_argument('-c', '--config', type=str, nargs='+', required=True, help='base config files')
+    parser.add_argument('-s', '--sweep', type=str, required=True, help='sweep spec (yaml)')
+    parser.add_argument('-t', '--target', type=str, required=True, help='package.module:function called with the config')
+    parser.add_argument('-o', '--output', type=str, default='./sweep', help='directory for run dumps and index.json')
+    parser.add_argument('-j', '--max-workers', type=int, default=None)
+    parsed_args = parser.parse_args(args)
+
+    config = Config.get_instance() if Config._instance is not None else Config(parsed_args.config)
+    summary = run(import_target(parsed_args.target), load_yaml(parsed_args.sweep), config=config,
+                  output_dir=parsed_args.output, max_workers=parsed_args.max_workers)
+    failed = [entry['run'] for entry in summary if entry['status'] != 'ok']
+    LOGGER.info('[sweep] %d runs, %d failed', len(summary), len(failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())